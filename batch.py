@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+batch.py
+
+Renders whole corpora: every sentence of every input file gets its own
+output file, named after the input file and the sentence's index in it,
+
+  OUTDIR/<file>.00000.pdf, OUTDIR/<file>.00001.pdf, ...
+
+(for jsent lines with both a tree and dependencies, the converter name is
+added: <file>.00000.jsent_to_tree_tuples.pdf).  Directories are walked and
+keep their structure under OUTDIR.  Formats are detected per file, as
+parseviz does for STDIN.
+
+Sentences whose output is newer than their input file are skipped, so an
+interrupted run picks up where it stopped.  The work is spread over one
+process per CPU.
+
+  ./batch.py [-o OUTDIR] [-pdf|-svg|-html|-png|-eps] [-j N] [-merged FILE] [-force] [-tree]
+      [-maxnodes N] [-maxdepth N] PATH...
+
+-merged FILE also joins all the pages, in input order, into one PDF (or
+SVG/HTML page).  -tree leaves out the dependencies of jsent input.
+-maxnodes and -maxdepth summarize the subtrees of big trees, as parseviz's
+do.
+"""
+
+from __future__ import with_statement
+import sys,os,multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import parseviz
+
+def input_files(paths):
+  """(input path, output name) for each file, directories walked in order"""
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path, os.path.basename(path)
+      continue
+    top = os.path.dirname(os.path.normpath(path))
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames.sort()
+      for name in sorted(filenames):
+        if name.startswith('.'): continue
+        full = os.path.join(dirpath, name)
+        yield full, os.path.relpath(full, top)
+
+def up_to_date(output, input):
+  try:
+    return os.path.getmtime(output) >= os.path.getmtime(input)
+  except OSError:
+    return False
+
+def page_tasks(path, name, outdir, format, options=None):
+  """(to_tuples, parse, output path) for every page of one input file"""
+  with open(path) as f:
+    input = f.read().strip()
+  input_format, parses = parseviz.detect_type(input)
+  if input_format is None: return
+  fmt = parseviz.format_named(input_format)
+  for i, parse in enumerate(parses):
+    converters = fmt.converters(parse, options or {})
+    for to_tuples in converters:
+      tag = ".%s" % to_tuples.__name__ if len(converters) > 1 else ""
+      yield to_tuples, parse, os.path.join(outdir, "%s.%05d%s.%s" % (name, i, tag, format))
+
+def render_to_file(task):
+  """runs in the worker processes.  Returns (output path, error or None)."""
+  to_tuples, parse, output, format = task
+  tmp = "%s.%d.tmp" % (output, os.getpid())
+  try:
+    tuples = to_tuples(parse)
+    if format=='html':
+      parseviz.make_html(tmp, parseviz.make_svg(tuples))
+    elif format=='svg':
+      with open(tmp, 'w') as f:
+        svg = parseviz.make_svg(tuples)
+        f.write(svg.encode('utf8') if isinstance(svg,unicode) else svg)
+    else:
+      parseviz.call_dot(parseviz.dot_chunks(tuples), tmp, format=format)
+    # only complete pages get the real name, so they're the only ones a
+    # resumed run skips
+    os.rename(tmp, output)
+  except Exception, e:
+    if os.path.exists(tmp): os.remove(tmp)
+    return output, "%s: %s" % (e.__class__.__name__, e)
+  return output, None
+
+def batch_process(paths, outdir, format='pdf', workers=None, merged=None, force=False, options=None):
+  """Renders one page per sentence of the files and directories in paths
+  into outdir.  Returns (pages in input order, {page: error} for failures)."""
+  pages = []
+  tasks = []
+  for path, name in input_files(paths):
+    subdir = os.path.dirname(os.path.join(outdir, name))
+    if not os.path.isdir(subdir): os.makedirs(subdir)
+    for to_tuples, parse, output in page_tasks(path, name, outdir, format, options):
+      pages.append(output)
+      if force or not up_to_date(output, path):
+        tasks.append((to_tuples, parse, output, format))
+  errors = {}
+  if tasks:
+    pool = multiprocessing.Pool(workers or parseviz.WORKERS)
+    try:
+      for output, error in pool.imap_unordered(render_to_file, tasks, chunksize=4):
+        if error:
+          errors[output] = error
+          print>>sys.stderr, "FAILED", output, error
+        elif not parseviz.QUIET:
+          print "WROTE", output
+    finally:
+      pool.close()
+      pool.join()
+  if not parseviz.QUIET:
+    print "%d pages, %d rendered, %d up to date, %d failed" % (
+        len(pages), len(tasks)-len(errors), len(pages)-len(tasks), len(errors))
+  if merged:
+    merge_pages([p for p in pages if p not in errors], merged, format)
+  return pages, errors
+
+def merge_pages(pages, output, format):
+  if format=='pdf':
+    parseviz.merge_pdfs(pages, output)
+  elif format in parseviz.BUILTIN_FORMATS:
+    svgs = []
+    for page in pages:
+      with open(page) as f:
+        s = f.read()
+      # the <svg> element out of each single-page file
+      svgs.append(s[s.index('<svg'):s.rindex('</svg>')+len('</svg>')])
+    if format=='html':
+      parseviz.make_html(output, svgs)
+    else:
+      parseviz.write_svg(output, svgs)
+  else:
+    raise ValueError("can only merge pdf, svg or html pages, not %s" % format)
+
+if __name__=='__main__':
+  args = sys.argv[1:]
+  def flag_value(name, default):
+    if name not in args: return default
+    i = args.index(name)
+    value = args[i+1]
+    del args[i:i+2]
+    return value
+  outdir = flag_value('-o', 'parseviz_out')
+  workers = int(flag_value('-j', 0)) or None
+  merged = flag_value('-merged', None)
+  formats = [a[1:] for a in args if a in ('-pdf','-svg','-html','-png','-eps')]
+  format = formats[-1] if formats else 'pdf'
+  force = '-force' in args
+  options = {'tree_only': '-tree' in args}
+  parseviz.MAX_NODES = int(flag_value('-maxnodes', 0)) or None
+  parseviz.MAX_DEPTH = int(flag_value('-maxdepth', 0)) or None
+  paths = [a for a in args if not a.startswith('-')]
+  if not paths:
+    print>>sys.stderr, __doc__
+    sys.exit(1)
+  pages, errors = batch_process(paths, outdir, format, workers=workers, merged=merged,
+      force=force, options=options)
+  if merged:
+    print "OUTPUT", merged
+  sys.exit(1 if errors else 0)
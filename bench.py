@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+bench.py
+
+Times each stage of parseviz separately over the inputs in examples/:
+format detection, parsing/conversion, graph tuples, DOT and SVG output,
+rendering with dot, PDF merging, and docviz's convert_document.  For every
+stage it prints the best time of a few runs, throughput, and the peak
+memory it added (measured in a fresh child process per stage), then how
+the main stages scale with input size.
+
+  ./bench.py [-repeat 3] [-render 20] [-only stage,stage] [-save FILE] [-compare FILE]
+
+-save writes the results as JSON; -compare FILE prints them next to an
+earlier saved run, marking stages more than 10% slower.  The render and
+merge stages need 'dot' on the PATH and are skipped without it.
+"""
+
+from __future__ import with_statement
+import sys,os,time,json,subprocess,resource
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+from xml.etree import ElementTree as ET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import parseviz, pdfmerge, docviz
+
+EXAMPLES = os.path.join(HERE, 'examples')
+# docviz input, not a parse
+DOCVIZ_EXAMPLE = 'corenlp.xml'
+
+def read_examples():
+  """{filename: contents} for the parse examples"""
+  texts = {}
+  for name in sorted(os.listdir(EXAMPLES)):
+    path = os.path.join(EXAMPLES, name)
+    if os.path.isfile(path) and name != DOCVIZ_EXAMPLE:
+      texts[name] = open(path).read()
+  return texts
+
+def corpus(texts):
+  """detected parses by format: {'sexpr': [...], 'conll': [...], 'malt': [...]}"""
+  parses = {}
+  for name in sorted(texts):
+    input_format, parts = parseviz.detect_type(texts[name].strip())
+    # conll_tab and sexpr_multiline are read the same as conll and sexpr
+    parses.setdefault(input_format.split('_')[0], []).extend(parts)
+  return parses
+
+## Stages.  setup() builds the stage's input from the examples, outside
+## the timing; run(input) does the work once and returns (units, bytes),
+## what throughput is counted in.
+
+class Stage(object):
+  unit = 'parses'
+  needs_dot = False
+  def setup(self, data): return data
+  def run(self, input): raise NotImplementedError
+
+class Detect(Stage):
+  unit = 'files'
+  def setup(self, data): return [t.strip() for t in data.texts.values()]
+  def run(self, texts):
+    for t in texts: parseviz.detect_type(t)
+    return len(texts), sum(len(t) for t in texts)
+
+class ParseSexpr(Stage):
+  def setup(self, data): return data.parses.get('sexpr', [])
+  def run(self, parses):
+    for p in parses: parseviz.parse_sexpr(p)
+    return len(parses), sum(len(p) for p in parses)
+
+class Convert(Stage):
+  def __init__(self, input_format, to_tuples):
+    self.input_format = input_format
+    self.to_tuples = to_tuples
+  def setup(self, data): return data.parses.get(self.input_format, [])
+  def run(self, parses):
+    for p in parses: self.to_tuples(p)
+    return len(parses), sum(len(p) for p in parses)
+
+class GraphTuples(Stage):
+  unit = 'trees'
+  def setup(self, data): return [parseviz.parse_sexpr(p) for p in data.parses.get('sexpr', [])]
+  def run(self, trees):
+    n = 0
+    for t in trees: n += len(list(parseviz.graph_tuples(t)))
+    return len(trees), n
+
+class DotSource(Stage):
+  unit = 'graphs'
+  def setup(self, data): return data.tuples()
+  def run(self, graphs):
+    return len(graphs), sum(len(parseviz.dot_from_tuples(g)) for g in graphs)
+
+class Svg(Stage):
+  unit = 'graphs'
+  def setup(self, data): return data.tuples()
+  def run(self, graphs):
+    return len(graphs), sum(len(parseviz.make_svg(g)) for g in graphs)
+
+class Render(Stage):
+  unit = 'pages'
+  needs_dot = True
+  def setup(self, data): return data.tuples()[:data.render_limit]
+  def run(self, graphs):
+    pages = parseviz.render_pages(graphs, format='pdf')
+    return len(pages), sum(len(p) for p in pages)
+
+class Merge(Stage):
+  unit = 'pages'
+  needs_dot = True
+  def setup(self, data):
+    return parseviz.render_pages(data.tuples()[:data.render_limit], format='pdf', workers=1)
+  def run(self, pages):
+    out = StringIO()
+    pdfmerge.merge(pages, out)
+    return len(pages), len(out.getvalue())
+
+class ConvertDocument(Stage):
+  unit = 'sentences'
+  def setup(self, data):
+    return ET.fromstring(open(os.path.join(EXAMPLES, DOCVIZ_EXAMPLE)).read())
+  def run(self, xm):
+    doc = docviz.convert_document(xm)
+    return len(doc['sentences']), sum(len(s['tokens']) for s in doc['sentences'])
+
+STAGES = [
+  ('detect_type', Detect()),
+  ('parse_sexpr', ParseSexpr()),
+  ('conll_to_tuples', Convert('conll', parseviz.conll_to_tuples)),
+  ('malt_to_tuples', Convert('malt', parseviz.malt_to_tuples)),
+  ('graph_tuples', GraphTuples()),
+  ('dot_from_tuples', DotSource()),
+  ('make_svg', Svg()),
+  ('render', Render()),
+  ('merge', Merge()),
+  ('convert_document', ConvertDocument()),
+]
+
+class Data(object):
+  def __init__(self, render_limit=20):
+    self.texts = read_examples()
+    self.parses = corpus(self.texts)
+    self.render_limit = render_limit
+    self._tuples = None
+  def tuples(self):
+    """graph tuple lists for every example parse"""
+    if self._tuples is None:
+      self._tuples = [list(parseviz.sexpr_to_tuples(p)) for p in self.parses.get('sexpr', [])]
+      self._tuples += [parseviz.conll_to_tuples(p) for p in self.parses.get('conll', [])]
+      self._tuples += [parseviz.malt_to_tuples(p) for p in self.parses.get('malt', [])]
+    return self._tuples
+
+def best_time(f, input, repeat):
+  best = None
+  for i in range(repeat):
+    t0 = time.time()
+    ret = f(input)
+    elapsed = time.time() - t0
+    if best is None or elapsed < best: best = elapsed
+  return best, ret
+
+def maxrss_kb():
+  r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return r/1024 if sys.platform=='darwin' else r   # bytes on mac, KB on linux
+
+def measure_peak(name):
+  """runs one stage in a fresh process; KB of peak memory the stage added
+  on top of its setup"""
+  cmd = [sys.executable, os.path.abspath(__file__), '-memory', name]
+  out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+  try:
+    return int(out.split()[-1])
+  except (ValueError, IndexError):
+    return None
+
+def memory_child(name, data):
+  stage = dict(STAGES)[name]
+  input = stage.setup(data)
+  before = maxrss_kb()
+  stage.run(input)
+  print max(0, maxrss_kb() - before)
+
+def run_stages(data, names, repeat):
+  have_dot = find_executable('dot') is not None
+  results = {}
+  for name, stage in STAGES:
+    if name not in names: continue
+    if stage.needs_dot and not have_dot:
+      print >>sys.stderr, "%-18s skipped, no dot on the PATH" % name
+      continue
+    input = stage.setup(data)
+    seconds, (units, nbytes) = best_time(stage.run, input, repeat)
+    results[name] = {'seconds':seconds, 'units':units, 'unit':stage.unit,
+        'bytes':nbytes, 'peak_kb':measure_peak(name)}
+    print_stage(name, results[name])
+  return results
+
+def print_stage(name, r):
+  rate = r['units']/r['seconds'] if r['seconds'] else float('inf')
+  kbs = r['bytes']/1024.0/r['seconds'] if r['seconds'] else float('inf')
+  print "%-18s %9.4fs %8d %-9s %10.1f/s %10.1f KB/s  peak +%s KB" % (
+      name, r['seconds'], r['units'], r['unit'], rate, kbs,
+      '?' if r['peak_kb'] is None else r['peak_kb'])
+
+## Scaling: the same stage over growing inputs.  Time per unit should stay
+## flat if the stage is linear.
+
+def scaling(data, repeat):
+  curves = {}
+  malt = data.parses.get('malt', [])
+  sizes = [n for n in (10, 100, 1000) if n < len(malt)] + [len(malt)]
+  text = "\n".join(malt)
+  lines = text.split("\n")
+  curves['detect_type (lines)'] = [(n, best_time(parseviz.detect_type, "\n".join(lines[:n]), repeat)[0])
+      for n in sizes]
+  curves['malt_to_tuples (sentences)'] = [(n, best_time(
+      lambda ps: [parseviz.malt_to_tuples(p) for p in ps], malt[:n], repeat)[0]) for n in sizes]
+  # one tree made of k copies of the biggest example tree
+  sexprs = data.parses.get('sexpr', [])
+  if sexprs:
+    big = max(sexprs, key=len)
+    nodes = len(parseviz.parse_sexpr(big).labels)
+    for stage in ('parse_sexpr', 'graph_tuples', 'dot_from_tuples'):
+      curves['%s (nodes)' % stage] = []
+    for k in (1, 4, 16, 64):
+      s = "(ROOT %s)" % " ".join([big]*k)
+      tree = parseviz.parse_sexpr(s)
+      tuples = list(parseviz.graph_tuples(tree))
+      n = k*nodes
+      curves['parse_sexpr (nodes)'].append((n, best_time(parseviz.parse_sexpr, s, repeat)[0]))
+      curves['graph_tuples (nodes)'].append((n, best_time(lambda t: list(parseviz.graph_tuples(t)), tree, repeat)[0]))
+      curves['dot_from_tuples (nodes)'].append((n, best_time(parseviz.dot_from_tuples, tuples, repeat)[0]))
+  for name in sorted(curves):
+    print "%-28s %s" % (name, "  ".join("%d: %.1fus/unit" % (n, 1e6*t/n) for n,t in curves[name]))
+  return curves
+
+def compare(results, baseline, tolerance=0.10):
+  print
+  print "%-18s %10s %10s %8s" % ("vs baseline", "before", "now", "ratio")
+  for name, _ in STAGES:
+    if name not in results or name not in baseline['stages']: continue
+    old = baseline['stages'][name]['seconds']
+    new = results[name]['seconds']
+    ratio = new/old if old else float('inf')
+    flag = "  SLOWER" if ratio > 1+tolerance else "  faster" if ratio < 1-tolerance else ""
+    print "%-18s %9.4fs %9.4fs %7.2fx%s" % (name, old, new, ratio, flag)
+
+def arg(name, default):
+  return sys.argv[sys.argv.index(name)+1] if name in sys.argv else default
+
+if __name__=='__main__':
+  parseviz.QUIET = True
+  data = Data(render_limit=int(arg('-render', 20)))
+  if '-memory' in sys.argv:
+    memory_child(arg('-memory', None), data)
+    sys.exit(0)
+  repeat = int(arg('-repeat', 3))
+  names = arg('-only', ",".join(name for name,_ in STAGES)).split(',')
+  print "%d example files: %s" % (len(data.texts),
+      ", ".join("%d %s" % (len(ps), f) for f,ps in sorted(data.parses.items())))
+  results = run_stages(data, names, repeat)
+  print
+  curves = scaling(data, repeat)
+  if '-compare' in sys.argv:
+    compare(results, json.load(open(arg('-compare', None))))
+  if '-save' in sys.argv:
+    with open(arg('-save', None), 'w') as f:
+      json.dump({'stages':results, 'scaling':curves, 'repeat':repeat,
+          'python':sys.version.split()[0], 'time':time.time()}, f, indent=2, sort_keys=True)
@@ -1,13 +1,7 @@
 #!/usr/bin/env python
-import sys
-d = 0
-for line in sys.stdin:
-  for c in line:
-    if c=='(': d+=1
-    if c==')': d-=1
-  if d>0:
-    print line.strip(),
-  elif d==0:
-    print line.strip()
-  else: assert False, "wtf"
-
+# joins multi-line bracketed trees into one line per tree
+import sys,os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from parseviz import split_sexprs
+for tree in split_sexprs(sys.stdin):
+  print " ".join(tree.split())
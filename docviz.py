@@ -2,7 +2,7 @@
 
 from xml.etree import ElementTree as ET
 from pprint import pprint
-import json
+import os,json,codecs,bisect
 
 def css():
 
@@ -40,31 +40,51 @@ def token_html(tok, left='', right=''):
   )
   return h
 
-def sent_html(sent_id, sent, tok_ents):
+def sent_html(sent_id, sent, spans):
+  """spans: the sentence's mentions as (start, end, entity num, k) sorted by
+  start, k being the mention's place in its entity (see mention_spans)"""
   h = ""
   h += "<div class=sent>"
   h += "<div style='vertical-align:top; display:inline-block; padding-right:10pt'>"
   h += "<a name='S{snum}'>(S{snum})</a></div>".format(snum=sent_id)
   N = len(sent['tokens'])
-  cur_ents = set()
+  # an entity's bracket spans each run of tokens it covers without a gap,
+  # so overlapping or adjacent mentions of one entity share a bracket
+  opens = [[] for i in range(N)]
+  closes = [[] for i in range(N)]
+  run_end = {}   # entity num -> end of its current run
+  for start, end, num, k in spans:
+    if end <= start: continue
+    if num in run_end and start <= run_end[num]:
+      run_end[num] = max(run_end[num], end)
+      continue
+    if num in run_end:
+      closes[run_end[num]-1].append(num)
+    opens[start].append(num)
+    run_end[num] = end
+  for num, end in run_end.items():
+    closes[end-1].append(num)
+
+  # the mentions covering the current token, in entity order
+  active = []
+  ending = [[] for i in range(N)]
+  j = 0
   for i,tok in enumerate(sent['tokens']):
-    if tok_ents[i]:
-      moreclass = [ "ent_num_%d" % e['num'] for e in tok_ents[i]]
-      moreclass = ' '.join(moreclass)
-    else:
-      moreclass = ''
-
-    left,right = "", ""
-    for ent in tok_ents[i]:
-      if ent not in cur_ents:
-        left += "<span class=ment_bracket>[</span>"
-        cur_ents.add(ent)
-    for cur_ent in set(cur_ents):
-      if i == N-1 or all(e != cur_ent for e in tok_ents[i+1]):
-        # right += "<span class=ment_bracket>]<span class=nice_ent_sub>%s</span></span>" % (cur_ent['nice_id'])
-        right += "<span class=ment_bracket>]<span class=nice_ent_sub><a href='#{eid}'>{eid}</a> </span></span>".format(eid=cur_ent['nice_id'])
-        
-        cur_ents.remove(cur_ent)
+    while j < len(spans) and spans[j][0] <= i:
+      start, end, num, k = spans[j]
+      if end > i:
+        bisect.insort(active, (num, k))
+        ending[end-1].append((num, k))
+      j += 1
+    moreclass = ' '.join("ent_num_%d" % num for num,k in active)
+
+    left = "<span class=ment_bracket>[</span>" * len(opens[i])
+    right = ""
+    for num in sorted(closes[i]):
+      # right += "<span class=ment_bracket>]<span class=nice_ent_sub>%s</span></span>" % (cur_ent['nice_id'])
+      right += "<span class=ment_bracket>]<span class=nice_ent_sub><a href='#{eid}'>{eid}</a> </span></span>".format(eid="E%d" % num)
+    for m in ending[i]:
+      active.remove(m)
 
     th = token_html(tok, left=left, right=right)
 
@@ -106,31 +126,43 @@ class Entity(dict):
   def __hash__(self):
     return hash('entity::' + self['id'])
 
+def convert_mention(mention_x):
+  m = {}
+  m['sentence'] = int(mention_x.find('sentence').text) - 1
+  m['start'] = int(mention_x.find('start').text) - 1
+  m['end'] = int(mention_x.find('end').text) - 1
+  m['head'] = int(mention_x.find('head').text) - 1
+  return m
+
 def convert_coref(xm, sentences):
-  entities = []
+  mention_lists = []
   for entity_x in xm.find('document').find('coreference').findall('coreference'):
-    mentions = []
-    for mention_x in entity_x.findall('mention'):
-      m = {}
-      m['sentence'] = int(mention_x.find('sentence').text) - 1
-      m['start'] = int(mention_x.find('start').text) - 1
-      m['end'] = int(mention_x.find('end').text) - 1
-      m['head'] = int(mention_x.find('head').text) - 1
-      mentions.append(m)
+    mention_lists.append([convert_mention(m) for m in entity_x.findall('mention')])
+  entities = make_entities(mention_lists)
+  for ent in entities:
+    s,pos = ent['first_mention']
+    ent['nice_name'] = sentences[s]['tokens'][pos]['word']
+  return entities
+
+def make_entities(mention_lists):
+  """Entities from each coreference chain's mentions, numbered in order of
+  first mention.  nice_name is left for the caller, who has the words."""
+  entities = []
+  for mentions in mention_lists:
     ent = Entity()
     ent['mentions'] = mentions
     first_mention = min((m['sentence'],m['head']) for m in mentions)
     ent['first_mention'] = first_mention
     ent['id'] = '%s:%s' % first_mention
     entities.append(ent)
-  entities.sort()
+  # stable, so chains with the same first mention keep document order
+  entities.sort(key=lambda ent: ent['first_mention'])
   for i in range(len(entities)):
     ent = entities[i]
     ent['num'] = i
     s,pos = ent['first_mention']
     # ent['nice_id'] = '%s:%s' % (s,pos)
     ent['nice_id'] = "E%s" % i
-    ent['nice_name'] = sentences[s]['tokens'][pos]['word']
 
   return entities
 
@@ -138,55 +170,218 @@ def convert_document(xm):
   sentences = convert_sentences(xm)
   entities = convert_coref(xm, sentences)
 
-  # for each sentence, entity ID per token. different than lapata/barzilay "grid"
-  tok_ents = [ 
-      [ []  for i in range(len(sent['tokens']))]
-    for sent in sentences ]
+  # for each sentence, its mention spans.  different than lapata/barzilay "grid"
+  spans = mention_spans(entities)
+  sent_mentions = [spans.get(s, []) for s in range(len(sentences))]
+
+  return {'sentences':sentences, 'entities':entities, 'sent_mentions': sent_mentions}
+
+def mention_spans(entities):
+  """{sentence number: [(start, end, entity num, k)] sorted by start}, k
+  being the mention's position in the entity's list"""
+  spans = {}
   for ent in entities:
-    for ment in ent['mentions']:
-      for i in range(ment['start'], ment['end']):
-        tok_ents[ment['sentence']][i].append(ent)
-        ## very wasteful if JSON-d
+    for k,ment in enumerate(ent['mentions']):
+      spans.setdefault(ment['sentence'], []).append((ment['start'], ment['end'], ent['num'], k))
+  for sent_spans in spans.values():
+    sent_spans.sort()
+  return spans
 
-  return {'sentences':sentences, 'entities':entities, 'tok_ents': tok_ents}
+# Streaming: the same conversion with iterparse, for documents too big to
+# hold as an element tree.  Each <sentence> and <mention> element is
+# converted when it ends and then cleared, so memory holds one sentence's
+# XML plus the coreference chains (a few ints per mention).
 
+def iter_document(source, sentences=True):
+  """Yields ('sentence', sent) in document order (only if sentences is
+  true; otherwise sentence XML is just skipped), then ('coref', mentions)
+  per coreference chain."""
+  path = []   # (tag, element) of the open elements
+  mentions = []
+  for event, elem in ET.iterparse(source, events=('start','end')):
+    if event=='start':
+      path.append((elem.tag, elem))
+      continue
+    path.pop()
+    parent_tag, parent = path[-1] if path else (None, None)
+    if elem.tag=='sentence' and parent_tag=='sentences':
+      if sentences:
+        yield 'sentence', {
+            'id': int(elem.get('id')) - 1,
+            'tokens': convert_tokens(elem.find('tokens').findall('token')),
+            }
+      parent.remove(elem)
+    elif elem.tag=='mention':
+      mentions.append(convert_mention(elem))
+      parent.remove(elem)
+    elif elem.tag=='coreference' and parent_tag=='coreference':
+      yield 'coref', mentions
+      mentions = []
+      parent.remove(elem)
 
-if __name__=='__main__':
-  import sys
-  xm = ET.fromstring(open(sys.argv[1]).read())
-  doc = convert_document(xm)
+def stream_html(path, out):
+  """Writes the same page as write_html, one sentence at a time.  Reads the
+  file twice: first for the coreference chains at the end of the document,
+  then for the sentences."""
+  entities = make_entities([m for kind,m in iter_document(path, sentences=False)])
+  spans = mention_spans(entities)
+  first_mentions = {}
+  for ent in entities:
+    first_mentions.setdefault(ent['first_mention'], []).append(ent)
+  mention_words = {}
 
-  print "<head><style>"
-  print css()
-  print "</style></head> <body>"
-  for s,sent in enumerate(doc['sentences']):
-    print sent_html(s, sent, doc['tok_ents'][s])
+  print>>out, page_head()
+  s = 0
+  for kind, sent in iter_document(path):
+    if kind!='sentence': continue
+    words = [tok['word'] for tok in sent['tokens']]
+    for start, end, num, k in spans.get(s, []):
+      mention_words[s, start, end] = words[start:end]
+    for i in range(len(words)):
+      for ent in first_mentions.get((s,i), []):
+        ent['nice_name'] = words[i]
+    print>>out, sent_html(s, sent, spans.get(s, []))
+    out.flush()
+    s += 1
+  print>>out, entity_table(entities, lambda ment: mention_words[ment['sentence'], ment['start'], ment['end']])
 
-  print "<hr>"
+def page_head():
+  return "<head><style>\n%s\n</style></head> <body>" % css()
 
-  # print "<table>"
-  print "<table cellpadding=3 border=1 cellspacing=0 width='100%'>"
+def entity_table(entities, mention_words):
+  """mention_words(mention): the words of the mention"""
+  h = "<hr>\n"
+  # h += "<table>\n"
+  h += "<table cellpadding=3 border=1 cellspacing=0 width='100%'>\n"
 
-  for ent in doc['entities']:
-    # print """<div class="ent_info ent_num_%d">""" % ent['num']
-    print """<tr class="ent_info ent_num_%d">""" % ent['num']
+  for ent in entities:
+    # h += """<div class="ent_info ent_num_%d">\n""" % ent['num']
+    h += """<tr class="ent_info ent_num_%d">\n""" % ent['num']
 
     cells = []
     cells.append('<a name="{eid}">{eid}</a>'.format(eid=ent['nice_id']))
 
     hs = []
     for ment in ent['mentions']:
-      text = [doc['sentences'][ment['sentence']]['tokens'][i]['word'] for i in range(ment['start'], ment['end']) ]
-      #print ment
-      #print text
+      text = mention_words(ment)
       s = "%s <small>(%s:%s,%s-%s)</small>" % (' '.join(text),
         ment['sentence'], ment['head'], ment['start'], ment['end'])
       s = """<small><a href="#S{snum}">S{snum}</a></small> {text}""".format(snum=ment['sentence'], text=' '.join(text))
       hs.append(s)
     cells.append('<br>'.join(hs))
-    print "<tr>", "".join("<td>" + cell for cell in cells)
-    print "</tr>"
-  print "</table>"
-  #print "<pre>"
-  #print json.dumps(doc, indent=4)
-  #print "</pre>"
+    h += "<tr> " + "".join("<td>" + cell for cell in cells) + "\n"
+    h += "</tr>\n"
+  h += "</table>"
+  #h += "<pre>"
+  #h += json.dumps(doc, indent=4)
+  #h += "</pre>"
+  return h
+
+def write_html(doc, out):
+  print>>out, page_head()
+  for s,sent in enumerate(doc['sentences']):
+    print>>out, sent_html(s, sent, doc['sent_mentions'][s])
+  sentences = doc['sentences']
+  print>>out, entity_table(doc['entities'],
+      lambda ment: [sentences[ment['sentence']]['tokens'][i]['word'] for i in range(ment['start'], ment['end'])])
+
+# Columnar JSON: the document model in a form whose size grows with the
+# number of tokens and mentions only.  Token fields are parallel arrays over
+# all tokens of the document, POS and NER tags are indexes into vocabularies,
+# and each mention is one [sentence, start, end, head, entity] row.
+# Everything else (entity ids and names, sent_mentions) is rebuilt on load.
+
+COLUMNAR_FORMAT = 'docviz-columnar-1'
+
+def to_columnar(doc):
+  vocabs = {'POS': {}, 'NER': {}}
+  cols = {'word': [], 'lemma': [], 'POS': [], 'NER': []}
+  for sent in doc['sentences']:
+    for tok in sent['tokens']:
+      cols['word'].append(tok['word'])
+      cols['lemma'].append(tok['lemma'])
+      for k in ('POS','NER'):
+        cols[k].append(vocabs[k].setdefault(tok[k], len(vocabs[k])))
+  mentions = []
+  for ent in doc['entities']:
+    for m in ent['mentions']:
+      mentions.append([m['sentence'], m['start'], m['end'], m['head'], ent['num']])
+  return {
+      'format': COLUMNAR_FORMAT,
+      'sentence_ids': [sent['id'] for sent in doc['sentences']],
+      'sentence_lengths': [len(sent['tokens']) for sent in doc['sentences']],
+      'tokens': cols,
+      'vocab': dict((k, sorted(v, key=v.get)) for k,v in vocabs.items()),
+      'mentions': mentions,
+      }
+
+def from_columnar(d):
+  """the convert_document model back from to_columnar's output"""
+  if d.get('format') != COLUMNAR_FORMAT:
+    raise ValueError("not a %s document" % COLUMNAR_FORMAT)
+  cols = d['tokens']
+  pos_vocab, ner_vocab = d['vocab']['POS'], d['vocab']['NER']
+  sentences = []
+  t = 0
+  for sent_id, n in zip(d['sentence_ids'], d['sentence_lengths']):
+    tokens = []
+    for i in range(n):
+      tokens.append({'id': i, 'word': cols['word'][t], 'lemma': cols['lemma'][t],
+          'POS': pos_vocab[cols['POS'][t]], 'NER': ner_vocab[cols['NER'][t]]})
+      t += 1
+    sentences.append({'id': sent_id, 'tokens': tokens})
+  mention_lists = []
+  for s, start, end, head, num in d['mentions']:
+    while len(mention_lists) <= num: mention_lists.append([])
+    mention_lists[num].append({'sentence': s, 'start': start, 'end': end, 'head': head})
+  # already in entity order, which make_entities' stable sort keeps
+  entities = make_entities(mention_lists)
+  for ent in entities:
+    s,pos = ent['first_mention']
+    ent['nice_name'] = sentences[s]['tokens'][pos]['word']
+  spans = mention_spans(entities)
+  return {'sentences': sentences, 'entities': entities,
+      'sent_mentions': [spans.get(s, []) for s in range(len(sentences))]}
+
+def dump_columnar(doc, f):
+  json.dump(to_columnar(doc), f, separators=(',',':'))
+
+def load_columnar(f):
+  return from_columnar(json.load(f))
+
+def input_files(paths):
+  for path in paths:
+    if os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        if name.endswith('.xml'): yield os.path.join(path, name)
+    else:
+      yield path
+
+if __name__=='__main__':
+  # docviz.py [-stream|-json] FILE_OR_DIR...
+  # One file goes to STDOUT; with several (or a directory), each FILE gets
+  # a FILE.html.  -stream converts sentence by sentence, in bounded memory.
+  # -json writes the columnar JSON instead of HTML (FILE.json); .json
+  # inputs are loaded from it instead of converted from XML.
+  import sys
+  args = [a for a in sys.argv[1:] if a not in ('-stream','-json')]
+  files = list(input_files(args))
+  ext = '.json' if '-json' in sys.argv else '.html'
+  for filename in files:
+    if len(files)==1 and not os.path.isdir(args[0]):
+      out = sys.stdout
+    else:
+      out = codecs.open(filename + ext, 'w', 'utf8')
+    if filename.endswith('.json'):
+      doc = load_columnar(open(filename))
+    elif '-stream' in sys.argv and '-json' not in sys.argv:
+      stream_html(filename, out)
+      doc = None
+    else:
+      doc = convert_document(ET.fromstring(open(filename).read()))
+    if doc and '-json' in sys.argv:
+      dump_columnar(doc, out)
+    elif doc:
+      write_html(doc, out)
+    if out is not sys.stdout:
+      out.close()
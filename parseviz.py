@@ -21,77 +21,98 @@ and requires GraphViz to be installed - the 'dot' command.
 """
 
 from __future__ import with_statement
-import sys,os,time,pprint,re,json
+import sys,os,time,pprint,re,json,itertools,multiprocessing,collections,subprocess,threading,contextlib
+import tempfile,resource,signal
+from array import array
+import pdfmerge
 
 QUIET = False
 
-nounish = '#700070'
-verbish = '#207020'
-prepish = '#C35617'
-modifiers = '#902010'
-coordish = '#404090'
-fade = '#b0b0b0'
-
-# simpler alternatives
-#nounish = '#700070'
-#verbish = '#d02020'
-
-# nounish = 'black'
-# verbish = 'black'
-# prepish = 'black'
-# modifiers = 'black'
-# coordish = 'black'
-# fade = 'black'
-
-## LTH/pennconverter and penn2malt dependency label colors
-
-dep_colors = {
-# tricky. LTH uses SUB for "subordinate clause" but penn2malt uses it for "subject".
-  #'SUB': '#202090',
-  'SBJ': '#202090',
-  #'OBJ': '#903030',
-  #'OBJ': '#CC009C',
-  'OBJ': ' #9F336C',
-  'PMOD': prepish,
-  'COORD': coordish,
-  'CONJ': coordish,
-  #'SBAR': prepish,
-  'NMOD': nounish,
-  'VMOD': verbish,
-  'VC': verbish,
-  'AMOD': modifiers,
-  #'ADV': modifiers,
-  'P': fade,
-}
+# how many 'dot' processes to run at once when rendering many parses
+WORKERS = multiprocessing.cpu_count()
 
-## Stanford dependency label colors
-# parts out of the stanford dep hierarchy
-d = dep_colors
-for c in 'aux auxpass cop'.split(): d[c] = verbish
-for c in 'subj nsubj nsubjpass csubj'.split(): d[c] = d['SBJ']
-for c in 'obj dobj iobj '.split(): d[c] = d['OBJ']
-#for c in 'arg comp agent   attr ccomp xcomp compl mark rel acomp'.split(): d[c]=d['OBJ']
-  #if pos.startswith('prep'): return prepish
-#for c in 'mod advcl purpcl tmod rcmod amod infmod partmod num number  appos nn abbrev advmod neg poss possessive prt det prep'.split(): d[c]=d['AMOD']
-d['nn'] = nounish
-#d['amod'] = modifiers
-del d
+# a rendercache.RenderCache, to reuse pages of sentences rendered before
+CACHE = None
 
+# a Profile, to record where the time goes (see Profile)
+PROFILE = None
 
-def pos_color(pos):
-  if pos.startswith('VB') or pos=='MD': return verbish
-  if pos.startswith('NN') or pos.startswith('PRP') or pos.startswith('NNP'): return nounish
-  if pos in ('IN','TO'): return prepish
-  #if pos.startswith('JJ') or pos.endswith('DT'): return fade
-  if pos.startswith('RB') or pos.startswith('JJ'): return modifiers
+# limits on every dot (and gs) process: seconds of wall-clock time and MB of
+# memory.  A sentence that goes past them gets a placeholder page instead.
+RENDER_TIMEOUT = 60
+RENDER_MEMORY_MB = 2048
+
+# trees bigger than this many nodes, or deeper than MAX_DEPTH, get subtrees
+# drawn as one summary node each (see collapsed_nodes)
+MAX_NODES = None
+MAX_DEPTH = None
+
+# the shared label table and the theme's per-label styles are emptied when
+# they get this big, so a long-running server doesn't keep every label it
+# was ever sent
+LABEL_MEMO_SIZE = 10000
+
+## Label styles.  A theme names a palette, then maps POS tags and
+## constituent labels to palette colors (exact labels first, then the first
+## matching prefix), and dependency labels to colors and boldness.  Values
+## that aren't palette names are used as colors directly.  Theme files in
+## themes/ are JSON and can extend another theme, overriding parts of it.
 
-  if pos.startswith('NP'): return nounish
-  if pos.startswith('VP'): return verbish
-  if pos.startswith('PP'): return prepish
-  if pos in ('ADVP','ADJP'): return modifiers
-  if pos=='CC': return coordish
+DEFAULT_THEME = {
+  'colors': {
+    'nounish': '#700070',
+    'verbish': '#207020',
+    'prepish': '#C35617',
+    'modifiers': '#902010',
+    'coordish': '#404090',
+    'fade': '#b0b0b0',
+    'subj': '#202090',
+    #'obj': '#903030',
+    #'obj': '#CC009C',
+    'obj': ' #9F336C',
+  },
+  'pos': {
+    'exact': {'MD':'verbish', 'IN':'prepish', 'TO':'prepish',
+        'ADVP':'modifiers', 'ADJP':'modifiers', 'CC':'coordish'},
+    #if pos.startswith('JJ') or pos.endswith('DT'): return fade
+    'prefix': [['VB','verbish'], ['NN','nounish'], ['PRP','nounish'],
+        ['RB','modifiers'], ['JJ','modifiers'],
+        ['NP','nounish'], ['VP','verbish'], ['PP','prepish']],
+    'default': 'black',
+  },
+  ## LTH/pennconverter and penn2malt dependency label colors
+  'deps': {
+    # tricky. LTH uses SUB for "subordinate clause" but penn2malt uses it for "subject".
+    #'SUB': 'subj',
+    'SBJ': 'subj',
+    'OBJ': 'obj',
+    'PMOD': 'prepish',
+    'COORD': 'coordish',
+    'CONJ': 'coordish',
+    #'SBAR': 'prepish',
+    'NMOD': 'nounish',
+    'VMOD': 'verbish',
+    'VC': 'verbish',
+    'AMOD': 'modifiers',
+    #'ADV': 'modifiers',
+    'P': 'fade',
+    ## Stanford dependency label colors
+    # parts out of the stanford dep hierarchy
+    'aux': 'verbish', 'auxpass': 'verbish', 'cop': 'verbish',
+    'subj': 'subj', 'nsubj': 'subj', 'nsubjpass': 'subj', 'csubj': 'subj',
+    'obj': 'obj', 'dobj': 'obj', 'iobj': 'obj',
+    #arg comp agent attr ccomp xcomp compl mark rel acomp: obj
+    #mod advcl purpcl tmod rcmod amod infmod partmod num number appos nn abbrev advmod neg poss possessive prt det prep: modifiers
+    'nn': 'nounish',
+    #'amod': 'modifiers',
+  },
+  # dependency labels drawn in bold, e.g. ['SBJ','OBJ']
+  'bold': [],
+  # collapsed: summary nodes of subtrees left out (see MAX_NODES)
+  'shapes': {'leaf': 'box', 'nonterminal': 'none', 'token': 'none', 'collapsed': 'box'},
+}
 
-  return 'black'
+THEME_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'themes')
 
 ## some counts
 #1398844 NMOD
@@ -108,45 +129,171 @@ def pos_color(pos):
 #41906 PRD
 #9181 DEP
 
-#dep_bold = set(['SBJ','OBJ'])
-dep_bold = set([])
+class Theme(object):
+  """A theme compiled for lookups.  Each distinct label's style is worked
+  out once and remembered, so styling a node is a dict lookup."""
+  def __init__(self, spec):
+    self.spec = spec
+    palette = spec['colors']
+    color = lambda c: palette.get(c, c)
+    self.exact = dict((label, color(c)) for label,c in spec['pos']['exact'].items())
+    self.prefixes = [(prefix, color(c)) for prefix,c in spec['pos']['prefix']]
+    self.default = color(spec['pos']['default'])
+    self.dep_colors = dict((label, color(c)) for label,c in spec['deps'].items())
+    self.dep_bold = set(spec['bold'])
+    self.shapes = spec['shapes']
+    self.key = json.dumps(spec, sort_keys=True)
+    self._pos = {}
+    self._dep = {}
+
+  def pos_color(self, label):
+    """color for a POS tag or constituent label"""
+    try:
+      return self._pos[label]
+    except KeyError:
+      pass
+    if len(self._pos) >= LABEL_MEMO_SIZE: self._pos.clear()
+    c = self.exact.get(label)
+    if c is None:
+      c = self.default
+      for prefix, pc in self.prefixes:
+        if label.startswith(prefix):
+          c = pc
+          break
+    self._pos[label] = c
+    return c
+
+  def dep_style(self, deprel):
+    """edge options for a dependency label, besides the label itself"""
+    try:
+      return self._dep[deprel]
+    except KeyError:
+      pass
+    if len(self._dep) >= LABEL_MEMO_SIZE: self._dep.clear()
+    opts = {}
+    if deprel in self.dep_colors:
+      opts.update({'fontcolor':self.dep_colors[deprel], 'color':self.dep_colors[deprel]})
+    if deprel in self.dep_bold: opts['fontname'] = 'Times-Bold'
+    self._dep[deprel] = opts
+    return opts
+
+def theme_spec(name):
+  """name: 'default', a file in themes/ without the .json, or a path"""
+  if name=='default': return DEFAULT_THEME
+  path = name if os.path.exists(name) else os.path.join(THEME_DIR, name + '.json')
+  with open(path) as f:
+    spec = json.load(f)
+  if 'extends' in spec:
+    spec = merge_specs(theme_spec(spec.pop('extends')), spec)
+  return spec
+
+def merge_specs(base, over):
+  merged = dict(base)
+  for k,v in over.items():
+    merged[k] = merge_specs(base[k], v) if isinstance(v, dict) and isinstance(base.get(k), dict) else v
+  return merged
+
+def use_theme(name):
+  global THEME
+  THEME = Theme(theme_spec(name))
+  return THEME
+
+THEME = Theme(DEFAULT_THEME)
+
+def pos_color(pos):
+  return THEME.pos_color(pos)
+
+
+
+# nonterminal/POS labels are shared between all parsed trees
+_label_table = {}
+
+class Tree(object):
+  """Compact parse tree, as parallel arrays over the nodes.  Nodes are
+  numbered in preorder with the root at 0, so the subtree under node i is
+  exactly the nodes i..subtree_end[i]-1; its children are i+1, then each
+  following sibling starts where the previous one's subtree ends."""
+  __slots__ = ['labels','parents','is_leaf','subtree_end']
+
+  def __init__(self, labels, parents, is_leaf, subtree_end):
+    self.labels = labels            # list of str; the word, for leaves
+    self.parents = parents          # array of int, -1 for the root
+    self.is_leaf = is_leaf          # bytearray of 0/1
+    self.subtree_end = subtree_end  # array of int
 
+  def __len__(self):
+    return len(self.labels)
 
+  def children(self, i):
+    end = self.subtree_end
+    c = i+1
+    while c < end[i]:
+      yield c
+      c = end[c]
+
+  def num_children(self, i):
+    return sum(1 for c in self.children(i))
 
 def parse_sexpr(s):
-  s = s[s.find('('):]
-  tree = []
-  stack = []  # top of stack (index -1) points to current node in tree
-  stack.append(tree)
-  curtok = ""
+  """Parses the first tree in s into a Tree"""
+  # "(NP" stays one token: an open paren plus the node's label
+  toks = s.replace('(', ' (').replace(')', ' ) ').split()
+  # every node uses up at least one token, so this is enough room
+  size = len(toks)
+  labels = [None] * size
+  parents = array('i', [-1]) * size
+  is_leaf = bytearray(size)
+  end = array('i', [0]) * size
+  want_label = False   # a bare "(" was seen; the next atom is cur's label
+  table = _label_table
+  if len(table) >= LABEL_MEMO_SIZE: table.clear()
+  cur = -1   # innermost open node; the parents array doubles as the stack
+  n = 0
+  toks = iter(toks)
+  for tok in toks:
+    if tok==')':
+      if cur<0: continue   # junk before the tree
+      end[cur] = n
+      cur = parents[cur]
+      want_label = False
+      if cur<0: break
+    elif tok[0]=='(':
+      parents[n] = cur
+      cur = n
+      n += 1
+      want_label = len(tok)==1
+      if not want_label:
+        labels[cur] = table.setdefault(tok[1:], tok[1:])
+    elif cur<0:
+      continue
+    elif want_label:
+      labels[cur] = table.setdefault(tok, tok)
+      want_label = False
+    else:
+      labels[n] = tok
+      parents[n] = cur
+      is_leaf[n] = 1
+      end[n] = n+1
+      n += 1
   depth = 0
-  for c in s:
-    if c=='(':
-      new = []
-      stack[-1].append(new)
-      stack.append(new)
-      curtok = ""
-      depth += 1
-    elif c==')':
-      if curtok:
-        stack[-1].append(curtok)
-        curtok = ""
-      stack.pop()
-      curtok = ""
+  while cur>=0:
+    depth += 1
+    cur = parents[cur]
+  # the rest, after the first tree, only gets its parens checked
+  for tok in toks:
+    if tok[0]=='(': depth += 1
+    elif tok==')':
       depth -= 1
-    elif c.isspace():
-      if curtok:
-        stack[-1].append(curtok)
-        curtok = ""
-    else:
-      curtok += c
-    if depth<0: raise BadSexpr("Too many closing parens")
+      if depth<0: raise BadSexpr("Too many closing parens")
   if depth>0: raise BadSexpr("Didn't close all parens, depth %d" % depth)
-  root = tree[0]
+  if not n: raise BadSexpr("No tree")
+  del labels[n:], parents[n:], is_leaf[n:], end[n:]
   # weird
-  if isinstance(root[0], list):
-    root = ["ROOT"] + root
-  return root
+  if labels[0] is None:
+    labels[0] = "ROOT"
+  if None in labels:
+    labels = [L if L is not None else "" for L in labels]
+  return Tree(labels, parents, is_leaf, end)
 
 class BadSexpr(Exception): pass
 
@@ -159,81 +306,669 @@ def is_balanced(s):
     if d<0: return False
   return d==0
 
-def node_is_leaf(node):
-  return isinstance(node, (unicode,str))
-
-counter = 0
-def graph_tuples(node, parent_pos=None):
-  # makes both NODE and EDGE tuples from the tree
-  global counter
-  my_id = counter
-  if node_is_leaf(node):
-    col = pos_color(parent_pos)
-    return [("NODE", my_id, node, {'shape':'box','fontcolor':col, 'color':col})]
-  tuples = []
-  name = node[0]
-  name = name.replace("=H","")
-  #color = 'blue' if name=="NP" else 'black'
-  color = pos_color(name)
-  tuples.append(("NODE", my_id, name, {'shape':'none','fontcolor':color}))
-  
-  for child in node[1:]:
-    counter += 1
-    child_id = counter
-    opts = {}
-    if len(node)>2 and isinstance(child,list) and child[0].endswith("=H"):
-      opts['arrowhead']='none'
-      opts['style']='bold'
+def graph_tuples(tree, first_id=0, collapsed=()):
+  """Makes both NODE and EDGE tuples from the tree, lazily.
+  Node ids are first_id + the node's preorder index, so this is a single
+  pass over the node arrays; no recursion, however deep the tree.
+  collapsed: nonterminals drawn as a summary node instead of their subtree"""
+  labels, parents, is_leaf, end = tree.labels, tree.parents, tree.is_leaf, tree.subtree_end
+  theme = THEME
+  color_of = theme.pos_color
+  leaf_shape, nonterminal_shape = theme.shapes['leaf'], theme.shapes['nonterminal']
+  names = {}   # label with any =H head marker removed
+  def name_of(label):
+    if label not in names: names[label] = label.replace("=H","")
+    return names[label]
+
+  collapsed = set(collapsed)
+  i = 0
+  while i < len(labels):
+    p = parents[i]
+    if p>=0:
+      name = name_of(labels[p])
+      opts = {'arrowhead':'none'}
+      # head child among several siblings gets a bold edge
+      if not is_leaf[i] and end[p+1]<end[p] and labels[i].endswith("=H"):
+        opts['style']='bold'
+      opts['color'] = color_of(name) if is_leaf[i] else \
+          color_of(name) if color_of(labels[i]) == color_of(name) else \
+          'black'
+      yield ("EDGE", first_id+p, first_id+i, opts)
+    if i in collapsed:
+      col = color_of(name_of(labels[i]))
+      yield ("NODE", first_id+i, summary_label(tree, i),
+          {'shape':theme.shapes['collapsed'], 'style':'dashed', 'fontcolor':col, 'color':col})
+      i = end[i]
+      continue
+    if is_leaf[i]:
+      col = color_of(name_of(labels[p]))
+      yield ("NODE", first_id+i, labels[i], {'shape':leaf_shape,'fontcolor':col, 'color':col})
     else:
-      opts['arrowhead']='none'
-    opts['color'] = pos_color(name) if node_is_leaf(child) else \
-        pos_color(name) if pos_color(child[0]) == pos_color(name) else \
-        'black'
-    tuples.append(("EDGE", my_id, child_id, opts))
-    tuples += graph_tuples(child, name)
-  return tuples
+      name = name_of(labels[i])
+      #color = 'blue' if name=="NP" else 'black'
+      yield ("NODE", first_id+i, name, {'shape':nonterminal_shape,'fontcolor':color_of(name)})
+    i += 1
 
-def dot_from_tuples(tuples):
-  # takes graph_tuples and makes them into graphviz 'dot' format
-  dot = "digraph { "
+## Level of detail: a tree's subtrees are opened breadth first until the
+## next ones would take it past max_nodes nodes (or max_depth levels); the
+## rest are drawn as one node each, "NP (14 words)".  That bounds what dot
+## has to lay out per tree, however big the tree is.
+
+def collapsed_nodes(tree, max_nodes=None, max_depth=None):
+  """nonterminals to draw as summaries, in preorder.  POS tags come with
+  their word, so only phrases are summarized."""
+  if max_nodes is None and max_depth is None: return []
+  is_leaf, end = tree.is_leaf, tree.subtree_end
+  def preterminal(i): return end[i]==i+2 and is_leaf[i+1]
+  collapsed = []
+  shown = 1
+  level = [0]
+  depth = 0
+  while level:
+    below = []
+    for i in level:
+      if is_leaf[i] or preterminal(i): continue
+      kids = list(tree.children(i))
+      cost = len(kids) + sum(1 for c in kids if not is_leaf[c] and preterminal(c))
+      if (max_depth is not None and depth>=max_depth) or \
+         (max_nodes is not None and shown+cost>max_nodes):
+        collapsed.append(i)
+      else:
+        shown += cost
+        below.extend(kids)
+    level = below
+    depth += 1
+  collapsed.sort()
+  return collapsed
+
+def summary_label(tree, i):
+  words = tree.is_leaf[i:tree.subtree_end[i]].count('\x01')
+  return "%s (%d word%s)" % (tree.labels[i].replace("=H",""), words, "" if words==1 else "s")
+
+def subtree_sexpr(tree, i):
+  """the subtree under node i, written back out as an s-expression"""
+  labels, is_leaf, end = tree.labels, tree.is_leaf, tree.subtree_end
+  out = []
+  open_ends = []
+  for j in xrange(i, end[i]):
+    while open_ends and open_ends[-1]<=j:
+      out.append(")")
+      open_ends.pop()
+    if is_leaf[j]:
+      out.append(" " + labels[j])
+    else:
+      out.append(" (" + labels[j])
+      open_ends.append(end[j])
+  out.append(")" * len(open_ends))
+  return "".join(out).strip()
+
+def lod_tuples(tree):
+  # graph_tuples at the MAX_NODES/MAX_DEPTH level of detail
+  return graph_tuples(tree, collapsed=collapsed_nodes(tree, MAX_NODES, MAX_DEPTH))
+
+def dot_chunks(tuples):
+  # takes graph_tuples and yields them as pieces of graphviz 'dot' format
+  yield "digraph { "
   for t in tuples:
     if t[0]=="NODE":
       more = " ".join(['%s="%s"' % (k,v) for (k,v) in t[3].items()]) 
-      dot += """%s [label="%s" %s]; """ % (t[1], t[2], more)
+      yield """%s [label="%s" %s]; """ % (t[1], t[2], more)
     elif t[0]=="EDGE":
       more = " ".join(['%s="%s"' % (k,v) for (k,v) in t[3].items()]) 
-      dot += """ %s -> %s [%s]; """ % (t[1],t[2], more)
-  dot += "}"
-  return dot
+      yield """ %s -> %s [%s]; """ % (t[1],t[2], more)
+  yield "}"
+
+def dot_from_tuples(tuples):
+  return "".join(dot_chunks(tuples))
+
+## Built-in layout: positions the NODE/EDGE tuples ourselves and writes SVG,
+## so no 'dot' process is needed.  Linear in the number of tuples: leaves are
+## laid out left to right, each parent is centered over its children.
+
+SVG_FONT_SIZE = 12
+SVG_CHAR_WIDTH = 7.2   # rough average glyph width at SVG_FONT_SIZE
+SVG_LEVEL_HEIGHT = 40
+SVG_NODE_GAP = 10
+SVG_MARGIN = 10
+
+def xml_escape(s):
+  return s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;')
+
+def text_width(label):
+  return len(label) * SVG_CHAR_WIDTH
+
+def layout_tuples(tuples):
+  """Assigns (x,y) to every node of the forest given by graph tuples.
+  returns (positions, width, height), positions being a {id: (x,y)} dict."""
+  labels = {}
+  order = []
+  children = {}
+  has_parent = set()
+  for t in tuples:
+    if t[0]=="NODE":
+      if t[1] not in labels: order.append(t[1])
+      labels[t[1]] = t[2]
+    elif t[0]=="EDGE":
+      for n in (t[1],t[2]):
+        if n not in labels:
+          labels[n] = ""
+          order.append(n)
+      children.setdefault(t[1], []).append(t[2])
+      has_parent.add(t[2])
+  roots = [n for n in order if n not in has_parent]
+
+  pos = {}
+  depth = {}
+  next_x = [SVG_MARGIN]
+  max_depth = 0
+  for root in roots:
+    # iterative postorder, so deep trees don't hit the recursion limit
+    depth[root] = 0
+    stack = [(root, False)]
+    while stack:
+      node, done = stack.pop()
+      kids = children.get(node, [])
+      if not done:
+        stack.append((node, True))
+        for kid in reversed(kids):
+          if kid in depth: continue   # not a tree; ignore extra parents
+          depth[kid] = depth[node] + 1
+          stack.append((kid, False))
+        continue
+      y = SVG_MARGIN + SVG_FONT_SIZE + depth[node] * SVG_LEVEL_HEIGHT
+      max_depth = max(max_depth, depth[node])
+      placed = [pos[k][0] for k in kids if k in pos]
+      if placed:
+        x = (placed[0] + placed[-1]) / 2.0
+      else:
+        w = max(text_width(labels[node]), SVG_CHAR_WIDTH)
+        x = next_x[0] + w/2.0
+        next_x[0] += w + SVG_NODE_GAP
+      pos[node] = (x, y)
+  width = next_x[0] + SVG_MARGIN
+  height = 2*SVG_MARGIN + SVG_FONT_SIZE + max_depth * SVG_LEVEL_HEIGHT + SVG_FONT_SIZE/2
+  return pos, width, height
+
+def svg_arrowhead(x1, y1, x2, y2, color, size=6):
+  dx,dy = x2-x1, y2-y1
+  norm = (dx*dx + dy*dy) ** 0.5 or 1.0
+  ux,uy = dx/norm, dy/norm
+  bx,by = x2 - ux*size, y2 - uy*size
+  pts = [(x2,y2), (bx - uy*size/2, by + ux*size/2), (bx + uy*size/2, by - ux*size/2)]
+  return '<polygon points="%s" fill="%s"/>' % (" ".join("%.1f,%.1f" % p for p in pts), color)
 
 def make_svg(tuples):
-  assert False, "not done yet"
-  print tuples
-  words = [row for row in tuples if row[0]=='NODE']
+  """returns an <svg> element string for graph tuples, without calling dot"""
+  tuples = list(tuples)
+  if is_dependency_graph(tuples):
+    return make_arc_svg(tuples)
+  pos, width, height = layout_tuples(tuples)
+  half = SVG_FONT_SIZE * 0.7
+  out = []
+  out.append('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="Times,serif" font-size="%d">'
+      % (width, height, SVG_FONT_SIZE))
+  for t in tuples:
+    if t[0]!="EDGE": continue
+    opts = t[3]
+    (x1,y1),(x2,y2) = pos[t[1]], pos[t[2]]
+    color = opts.get('color', 'black').strip()
+    sw = 2 if opts.get('style')=='bold' else 1
+    out.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="%s" stroke-width="%d"/>'
+        % (x1, y1+half/2, x2, y2-half-2, color, sw))
+    if opts.get('arrowhead','normal')!='none' and opts.get('dir')!='none':
+      out.append(svg_arrowhead(x1, y1+half/2, x2, y2-half-2, color))
+    if 'label' in opts:
+      out.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-size="%d" fill="%s">%s</text>'
+          % ((x1+x2)/2.0, (y1+y2)/2.0, SVG_FONT_SIZE-2,
+            opts.get('fontcolor','black').strip(), xml_escape(opts['label'])))
+  for t in tuples:
+    if t[0]!="NODE": continue
+    opts = t[3]
+    x,y = pos[t[1]]
+    fontcolor = opts.get('fontcolor','black').strip()
+    if opts.get('shape')=='box':
+      w = text_width(t[2]) + 6
+      dash = ' stroke-dasharray="4,2"' if opts.get('style')=='dashed' else ''
+      out.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="none" stroke="%s"%s/>'
+          % (x-w/2.0, y-SVG_FONT_SIZE, w, SVG_FONT_SIZE+half, opts.get('color',fontcolor).strip(), dash))
+    out.append('<text x="%.1f" y="%.1f" text-anchor="middle" fill="%s">%s</text>'
+        % (x, y, fontcolor, xml_escape(t[2])))
+  out.append('</svg>')
+  return "\n".join(out)
 
-def make_html(filename, svg):
-  assert False, "not done yet"
-  with open(filename,'w') as f:
-    print>>f, svg
+## Dependency graphs are drawn as arc diagrams instead: tokens in order left
+## to right, each arc as high as the arcs nested (or crossing) under it need.
+
+ARC_LEVEL_HEIGHT = 20
+ARC_TOKEN_GAP = 14
+
+def is_dependency_graph(tuples):
+  # tokrecords_to_tuples labels every edge; graph_tuples never does
+  edges = [t for t in tuples if t[0]=="EDGE"]
+  return bool(edges) and all('label' in t[3] for t in edges)
+
+def arc_levels(spans, n):
+  """spans: (left, right) token positions of each arc, out of n tokens.
+  An arc's level is one more than the highest level of the shorter arcs
+  over any of the same gaps between tokens.  Arcs go shortest first into a
+  max segment tree over the gaps, so this is O(m log n)."""
+  size = 1
+  while size < n: size *= 2
+  under = [0] * (2*size)   # highest level anywhere in the node's gaps
+  over = [0] * (2*size)    # highest level covering all of the node's gaps
+  def update(node, lo, hi, l, r, level):
+    if r<=lo or hi<=l: return
+    under[node] = max(under[node], level)
+    if l<=lo and hi<=r:
+      over[node] = max(over[node], level)
+      return
+    mid = (lo+hi)//2
+    update(2*node, lo, mid, l, r, level)
+    update(2*node+1, mid, hi, l, r, level)
+  def query(node, lo, hi, l, r):
+    if r<=lo or hi<=l: return 0
+    if l<=lo and hi<=r: return under[node]
+    mid = (lo+hi)//2
+    return max(over[node], query(2*node, lo, mid, l, r), query(2*node+1, mid, hi, l, r))
+  levels = [0] * len(spans)
+  for i in sorted(range(len(spans)), key=lambda i: spans[i][1]-spans[i][0]):
+    l, r = spans[i]
+    if l >= r:
+      # a token attached to itself (malformed input) is over no gaps, and
+      # the segment tree would take it for a range
+      levels[i] = 1
+      continue
+    # gaps l..r-1 lie under the arc
+    levels[i] = query(1, 0, size, l, r) + 1
+    update(1, 0, size, l, r, levels[i])
+  return levels
+
+def make_arc_svg(tuples):
+  """returns an <svg> arc diagram for dependency graph tuples"""
+  nodes = sorted((t for t in tuples if t[0]=="NODE"), key=lambda t: t[1])
+  index = dict((t[1], i) for i,t in enumerate(nodes))
+  arcs = []    # (head position, dependent position, opts)
+  roots = []   # (dependent position, opts) for edges from outside the sentence
+  for t in tuples:
+    if t[0]!="EDGE" or t[2] not in index: continue
+    if t[1] in index:
+      arcs.append((index[t[1]], index[t[2]], t[3]))
+    else:
+      roots.append((index[t[2]], t[3]))
+  levels = arc_levels([(min(h,d), max(h,d)) for h,d,opts in arcs], len(nodes))
+  top = max(levels or [0]) + (1 if roots else 0)
+
+  # "word /POS" labels go on two lines
+  words = []
+  xs = []
+  x = SVG_MARGIN
+  for t in nodes:
+    word, slash, pos = t[2].rpartition(' /')
+    if not slash: word, pos = t[2], ''
+    w = max(text_width(word), text_width(pos), SVG_CHAR_WIDTH)
+    words.append((word, pos, t[3].get('fontcolor','black').strip()))
+    xs.append(x + w/2.0)
+    x += w + ARC_TOKEN_GAP
+  width = x - ARC_TOKEN_GAP + SVG_MARGIN
+  base = SVG_MARGIN + SVG_FONT_SIZE + top*ARC_LEVEL_HEIGHT   # where arcs end
+  word_y = base + SVG_FONT_SIZE + 2
+  height = word_y + SVG_FONT_SIZE + SVG_MARGIN
 
-def call_dot(dotstr, filename="/tmp/parseviz.png", format='png'):
-  dot = "/tmp/parseviz.%s.dot" % stamp()
-  with open(dot, 'w') as f:
-    print>>f, dotstr.encode('utf8')
+  out = []
+  out.append('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="Times,serif" font-size="%d">'
+      % (width, height, SVG_FONT_SIZE))
+  def label(x, y, opts):
+    weight = ' font-weight="bold"' if 'Bold' in opts.get('fontname','') else ''
+    out.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-size="%d" fill="%s"%s>%s</text>'
+        % (x, y, SVG_FONT_SIZE-2, opts.get('fontcolor','black').strip(), weight, xml_escape(opts['label'])))
+  for (h,d,opts),level in zip(arcs, levels):
+    color = opts.get('color','black').strip()
+    x1, x2 = xs[h], xs[d]
+    peak = level * ARC_LEVEL_HEIGHT
+    # control points at 4/3 of the height put the curve's top at the height
+    out.append('<path d="M %.1f %.1f C %.1f %.1f %.1f %.1f %.1f %.1f" fill="none" stroke="%s"/>'
+        % (x1, base, x1, base-peak*4/3.0, x2, base-peak*4/3.0, x2, base, color))
+    out.append(svg_arrowhead(x2, base-10, x2, base, color))
+    label((x1+x2)/2.0, base-peak-2, opts)
+  for d,opts in roots:
+    color = opts.get('color','black').strip()
+    y = base - top*ARC_LEVEL_HEIGHT
+    out.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="%s"/>' % (xs[d], y, xs[d], base, color))
+    out.append(svg_arrowhead(xs[d], base-10, xs[d], base, color))
+    label(xs[d], y-2, opts)
+  for x,(word,pos,fontcolor) in zip(xs, words):
+    out.append('<text x="%.1f" y="%.1f" text-anchor="middle" fill="%s">%s</text>'
+        % (x, word_y, fontcolor, xml_escape(word)))
+    out.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-size="%d" fill="%s">%s</text>'
+        % (x, word_y+SVG_FONT_SIZE, SVG_FONT_SIZE-2, fontcolor, xml_escape(pos)))
+  out.append('</svg>')
+  return "\n".join(out)
 
-  if False and format=='pdf':
-    cmd = "dot -Teps < " +dot+ " | ps2pdf -dEPSCrop -dEPSFitPage - > " + filename
+def stack_svgs(svgs):
+  """one <svg> document with the given <svg> elements stacked vertically"""
+  out = []
+  y = 0
+  width = 0
+  for svg in svgs:
+    w,h = [int(v) for v in re.search(r'width="(\d+)" height="(\d+)"', svg).groups()]
+    out.append(svg.replace('<svg ', '<svg y="%d" ' % y, 1))
+    y += h
+    width = max(width, w)
+  return '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">\n%s\n</svg>' % (
+      width, y, "\n".join(out))
+
+@contextlib.contextmanager
+def output_file(output):
+  # output: a filename, or a file-like object such as sys.stdout, which is
+  # left open
+  if isinstance(output, basestring):
+    with open(output, 'w') as f:
+      yield f
   else:
-    cmd = "dot -T" +format+ " < " +dot+ " > " + filename
-  if not QUIET:
-    print cmd
-  os.system(cmd)
+    yield output
+    output.flush()
+
+def html_pages(f, svgs):
+  """writes an HTML page of the svgs, flushing after each"""
+  print>>f, "<!doctype html>\n<html><head><meta charset=utf-8><title>parseviz</title></head><body>"
+  for s in svgs:
+    print>>f, "<div class=parse>"
+    print>>f, s.encode('utf8') if isinstance(s,unicode) else s
+    print>>f, "</div>"
+    f.flush()
+  print>>f, "</body></html>"
+
+def make_html(filename, svg):
+  if not isinstance(svg, (list,tuple)): svg = [svg]
+  with output_file(filename) as f:
+    html_pages(f, svg)
+
+def write_svg(filename, svgs):
+  with output_file(filename) as f:
+    s = stack_svgs(svgs)
+    print>>f, s.encode('utf8') if isinstance(s,unicode) else s
+
+class Profile(object):
+  """Wall time per stage, summed over the run, and per sentence.
+  Stages: detect, tuples (parsing and conversion), svg, dot_source
+  (generating DOT and piping it to dot), dot_process (the dot subprocess,
+  start to exit), render (all pages), merge, gs_merge.
+  Pass one as profile= (default: PROFILE) and dump report() as JSON."""
+  def __init__(self):
+    self.start = time.time()
+    self.seconds = collections.defaultdict(float)
+    self.calls = collections.defaultdict(int)
+    self.sentences = []
+    self.lock = threading.Lock()
+
+  def add(self, stage, seconds, sentence=None):
+    with self.lock:
+      self.seconds[stage] += seconds
+      self.calls[stage] += 1
+      if sentence is not None:
+        sentence[stage] = sentence.get(stage, 0) + seconds
+
+  def sentence(self, **info):
+    """a new per-sentence record, which timed() and call_dot fill in"""
+    rec = SentenceProfile(info)
+    rec.profile = self
+    with self.lock:
+      rec['index'] = len(self.sentences)
+      self.sentences.append(rec)
+    return rec
+
+  def report(self):
+    return {'wall_seconds': time.time() - self.start,
+        'stages': dict((k, {'seconds':v, 'calls':self.calls[k]}) for k,v in self.seconds.items()),
+        'sentences': self.sentences}
+
+class SentenceProfile(dict):
+  # a plain dict to json, plus the Profile it belongs to
+  profile = None
+
+@contextlib.contextmanager
+def timed(profile, stage, sentence=None):
+  if profile is None:
+    yield
+    return
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    profile.add(stage, time.time()-t0, sentence)
+
+class RenderError(Exception):
+  """A dot or gs process that failed, ran out of time or memory, or a
+  parse its converter couldn't read."""
+  def __init__(self, command, reason, returncode=None, message=''):
+    Exception.__init__(self, "%s: %s%s%s" % (command, reason,
+        "" if returncode is None else " (exit status %s)" % returncode,
+        message and ": " + message))
+    self.command = command
+    self.reason = reason   # 'timeout', 'memory', 'killed', 'failed' or 'unreadable'
+    self.returncode = returncode
+    self.message = message
+
+  def info(self):
+    return {'command':self.command, 'reason':self.reason,
+        'returncode':self.returncode, 'message':self.message}
+
+def error_text(e):
+  """str(e), even for an exception with a unicode message"""
+  try:
+    return str(e)
+  except UnicodeError:
+    return unicode(e).encode('utf8')
+
+def child_setup():
+  # runs in the child process, before exec.  Its own process group, so a
+  # kill gets anything it started too.
+  os.setpgrp()
+  if RENDER_MEMORY_MB:
+    limit = RENDER_MEMORY_MB*1024*1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+class Supervised(object):
+  """A child process under RENDER_MEMORY_MB, killed if it's still running
+  after timeout (default RENDER_TIMEOUT) seconds.  Talk to it through
+  .proc, then call finish()."""
+  def __init__(self, cmd, timeout=None, **popen_args):
+    self.name = cmd[0]
+    self.timeout = RENDER_TIMEOUT if timeout is None else timeout
+    self.timed_out = False
+    # a file, not a pipe, so nobody has to keep reading it
+    self.errors = tempfile.TemporaryFile()
+    # close_fds: otherwise a dot started from another render thread at the
+    # same time can hold this one's stdin open, and it never sees EOF
+    try:
+      self.proc = subprocess.Popen(cmd, preexec_fn=child_setup, stderr=self.errors, close_fds=True, **popen_args)
+    except OSError, e:
+      # not installed, or can't be run
+      self.errors.close()
+      raise RenderError(self.name, 'failed', message=str(e))
+    self.timer = None
+    if self.timeout:
+      self.timer = threading.Timer(self.timeout, self.kill)
+      self.timer.daemon = True
+      self.timer.start()
+
+  def kill(self):
+    if self.proc.returncode is not None: return
+    self.timed_out = True
+    try:
+      os.killpg(self.proc.pid, signal.SIGKILL)
+    except OSError:
+      pass
 
-counter = 0
+  def finish(self):
+    """waits for it to exit; raises RenderError unless it exited 0 in time"""
+    self.proc.wait()
+    if self.timer:
+      self.timer.cancel()
+      self.timer.join()
+    self.errors.seek(0)
+    message = self.errors.read().strip()[-300:]
+    self.errors.close()
+    if self.timed_out:
+      raise RenderError(self.name, 'timeout', message="killed after %ss" % self.timeout)
+    if self.proc.returncode:
+      reason = 'memory' if 'memory' in message.lower() else \
+          'killed' if self.proc.returncode < 0 else \
+          'failed'
+      raise RenderError(self.name, reason, self.proc.returncode, message)
+
+def call_dot(dot, filename=None, format='png', sentence=None, timeout=None):
+  """Pipes DOT into the dot command and returns the rendered bytes.
+  dot: a string, or an iterable of string pieces (see dot_chunks).
+  filename: also save the output there.
+  sentence: a SentenceProfile to record the timings in.
+  Raises RenderError if dot fails or takes longer than timeout (default
+  RENDER_TIMEOUT) seconds."""
+  if isinstance(dot, basestring): dot = [dot]
+  t0 = time.time()
+  supervised = Supervised(['dot', '-T'+format], timeout, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  proc = supervised.proc
+  # dot reads all of its input before writing anything, so this can't
+  # deadlock on a full stdout pipe
+  nbytes = 0
+  try:
+    for chunk in dot:
+      if isinstance(chunk,unicode): chunk = chunk.encode('utf8')
+      proc.stdin.write(chunk)
+      nbytes += len(chunk)
+    proc.stdin.close()
+  except IOError:
+    pass   # dot is gone; finish() says why
+  t1 = time.time()
+  output = proc.stdout.read()
+  supervised.finish()
+  if sentence is not None:
+    sentence.profile.add('dot_source', t1-t0, sentence)
+    sentence.profile.add('dot_process', time.time()-t0, sentence)
+    sentence['dot_bytes'] = nbytes
+    sentence['output_bytes'] = len(output)
+  if filename:
+    with open(filename, 'wb') as f:
+      f.write(output)
+  return output
+
+_stamps = itertools.count(1)
 def stamp():
-  global counter
-  counter += 1
-  return "%s.%s" % (os.getpid(), counter)
+  # itertools.count is safe to share between the render threads
+  return "%s.%s" % (os.getpid(), next(_stamps))
+
+_pools = {}
+def render_pool(workers):
+  """Thread pool that stays around between calls.  Threads are enough since
+  the real work happens in the dot subprocesses."""
+  from multiprocessing.pool import ThreadPool
+  if workers not in _pools:
+    _pools[workers] = ThreadPool(workers)
+  return _pools[workers]
+
+def render_page(tuples, format='pdf', sentence=None):
+  if isinstance(tuples, str): return tuples   # already rendered (cache hit)
+  try:
+    return call_dot(dot_chunks(tuples), format=format, sentence=sentence)
+  except RenderError, e:
+    if sentence is not None: sentence['error'] = e.info()
+    return placeholder_page(e, format)
+
+class Placeholder(str):
+  """A page standing in for one that couldn't be rendered; .error is the
+  RenderError"""
+
+def placeholder_page(error, format):
+  lines = ["This sentence could not be rendered.", str(error)[:100]]
+  if format=='pdf':
+    page = pdfmerge.text_page(lines)
+  elif format in BUILTIN_FORMATS:
+    page = make_svg([("NODE", 0, " ".join(lines), {'shape':'box'})])
+  else:
+    # one node is quick to lay out, even when the real graph wasn't
+    label = r"\n".join(line.replace('"',"'").replace('\\','/') for line in lines)
+    try:
+      page = call_dot(dot_from_tuples([("NODE", 0, label, {'shape':'box'})]), format=format)
+    except RenderError:
+      page = ''
+  page = Placeholder(page)
+  page.error = error
+  return page
+
+def render_stream(jobs, format='pdf', workers=None, sentences=None):
+  """jobs: iterable of graph tuple sequences, one per page.  Renders them
+  concurrently and yields the output bytes in the same order as the jobs,
+  each as soon as it and everything before it is done.  Only a couple of
+  jobs per worker are pulled from the iterable at a time, so it can be an
+  unbounded generator.
+  sentences: deque that gets a SentenceProfile (or None) appended per job,
+  by whatever generates them"""
+  workers = workers or WORKERS
+  def sentence():
+    return sentences.popleft() if sentences else None
+  if workers <= 1:
+    for job in jobs:
+      yield render_page(job, format, sentence())
+    return
+  pool = render_pool(workers)
+  pending = collections.deque()
+  for job in jobs:
+    pending.append(pool.apply_async(render_page, (job, format, sentence())))
+    if len(pending) >= 2*workers:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def render_pages(jobs, format='pdf', workers=None):
+  """jobs: list of graph tuple sequences.  Renders them concurrently and
+  returns the output bytes in the same order as the jobs."""
+  return list(render_stream(jobs, format=format, workers=workers))
+
+def merge_pdfs(inputs, output, profile=None):
+  """Concatenates the input PDFs (as bytes or filenames) in order.
+  output: filename, or a file-like object such as sys.stdout.  Pages
+  pdfmerge can't read go through classic_pdf first."""
+  profile = profile or PROFILE
+  with timed(profile, 'merge'):
+    pdfmerge.merge([mergeable_pdf(pdf, profile) for pdf in inputs], output)
+  return output
+
+def mergeable_pdf(pdf, profile=None):
+  """pdf (bytes or filename) as a pdfmerge.SourcePdf, rewritten by
+  classic_pdf if pdfmerge can't read it as it is"""
+  try:
+    return pdfmerge.load(pdf)
+  except pdfmerge.PdfError:
+    # e.g. xref streams from a cairo dot
+    if not pdf.startswith('%PDF'):
+      with open(pdf, 'rb') as f:
+        pdf = f.read()
+    return pdfmerge.load(classic_pdf(pdf, profile))
+
+def classic_pdf(pdf, profile=None):
+  """pdf rewritten by gs with a classic xref table, which pdfmerge reads;
+  a placeholder page if that doesn't work either"""
+  import shutil
+  tmpdir = tempfile.mkdtemp(prefix='parseviz.')
+  try:
+    name = os.path.join(tmpdir, "in.pdf")
+    with open(name, 'wb') as f:
+      f.write(pdf)
+    output = os.path.join(tmpdir, "out.pdf")
+    with timed(profile, 'gs_merge'):
+      gs = Supervised(['gs','-q','-dNOPAUSE','-dBATCH','-sDEVICE=pdfwrite',
+          '-dWriteObjStms=false','-dWriteXRefStm=false','-sOutputFile='+output, name])
+      gs.finish()
+    with open(output, 'rb') as f:
+      converted = f.read()
+    pdfmerge.load(converted)
+    return converted
+  except (RenderError, pdfmerge.PdfError, EnvironmentError), e:
+    if not QUIET:
+      print>>sys.stderr, "FAILED to merge a page: %s" % e
+    return pdfmerge.text_page(["This page could not be merged.", str(e)[:100]])
+  finally:
+    shutil.rmtree(tmpdir)
 
 def open_file(filename):
   import webbrowser
@@ -243,10 +978,9 @@ def open_file(filename):
 
 def show_tree(sexpr, format):
   tree = parse_sexpr(sexpr)
-  tuples = graph_tuples(tree)
-  dotstr = dot_from_tuples(tuples)
-  filename = "/tmp/parseviz.%s.%s.%s" % (os.getid(), time.time(),format)
-  call_dot(dotstr, filename, format=format)
+  tuples = lod_tuples(tree)
+  filename = "/tmp/parseviz.%s.%s" % (stamp(), format)
+  call_dot(dot_chunks(tuples), filename, format=format)
   return filename
 
 # We seem to be using 1-indexing, so 0 is root
@@ -254,14 +988,14 @@ def show_tree(sexpr, format):
 def tokrecords_to_tuples(tokrecords):
   """returns tuples to turn into GraphViz directives"""
   ret = []
+  theme = THEME
+  shape = theme.shapes['token']
   for tokid, word_surface, pos, parent, deprel in tokrecords:
     if tokid != 0:
-      col = pos_color(pos)
-      ret.append(("NODE", tokid, "%s /%s" % (word_surface,pos), {'shape':'none', 'fontcolor':col}))
+      col = theme.pos_color(pos)
+      ret.append(("NODE", tokid, "%s /%s" % (word_surface,pos), {'shape':shape, 'fontcolor':col}))
     opts = {'label':deprel.lower(),'dir':'forward'}  #forward back both none
-    if deprel in dep_colors:
-      opts.update({'fontcolor':dep_colors[deprel], 'color':dep_colors[deprel]})
-    if deprel in dep_bold: opts['fontname'] = 'Times-Bold'
+    opts.update(theme.dep_style(deprel))
     if parent!=-1 and word_surface != 0:
       ret.append(("EDGE", parent,tokid, opts))
   return ret
@@ -284,12 +1018,11 @@ def malt_to_tuples(malt_string):
     bigtoks = malt_string.split()
     for myid,bigtok in enumerate(bigtoks):
       word,pos,parent,deprel = bigtok.split('/')
-      yield myid+1, word, pos, parent, deprel
+      yield myid+1, word, pos, int(parent), deprel
   return tokrecords_to_tuples(list(f()))
 
 def jsent_to_dep_tuples(jsent_line):
-  parts = jsent_line.split('\t')
-  jsent = json.loads(parts[-1])
+  jsent = jsent_record(jsent_line)
   def f():
     for k in ['deps','deps_cc']:
       if k in jsent:
@@ -308,19 +1041,128 @@ def show_conll(conll, format):
     svg = make_svg(tuples)
     make_html(filename, svg)
   else:
-    dotstr = dot_from_tuples(tuples)
-    call_dot(dotstr, filename, format=format)
+    call_dot(dot_chunks(tuples), filename, format=format)
   return filename
 
-def do_multi_tree(parses, to_tuples):  ##= lambda s: dot_from_tuples(graph_tuples(s))):
-  base = "/tmp/parseviz.%s_NUM.pdf" % stamp()
-  for i,parse in enumerate(parses):
-    output = base.replace("NUM", "%.03d" % (i+1))
-    call_dot(dot_from_tuples(to_tuples(parse)), filename=output, format='pdf')
-  output = base.replace("NUM","merged")
-  inputs = base.replace("NUM","*")
-  os.system("gs -q -dNOPAUSE -dBATCH -sDEVICE=pdfwrite -sOutputFile=%s %s" % (output,inputs))
-  return output
+# output formats we lay out ourselves instead of going through dot
+BUILTIN_FORMATS = ('svg','html')
+
+def write_svgs(svgs, format, out=None):
+  """out: file-like to write to, instead of a file in /tmp"""
+  filename = out or "/tmp/parseviz.%s_merged.%s" % (stamp(), format)
+  if format=='html':
+    make_html(filename, svgs)
+  else:
+    write_svg(filename, svgs)
+  return filename
+
+def style_key():
+  """everything besides the parse itself that changes how a page looks"""
+  if MAX_NODES is None and MAX_DEPTH is None:
+    return THEME.key
+  return "%s max_nodes=%s max_depth=%s" % (THEME.key, MAX_NODES, MAX_DEPTH)
+
+def normalize_parse(s):
+  # whitespace differences don't change the rendering
+  return "\n".join(" ".join(line.split()) for line in s.strip().split("\n") if line.strip())
+
+# converters that only ever split their input on whitespace.  jsent isn't
+# one: spaces inside its JSON strings are part of the words.
+SPACING_INSENSITIVE = ('sexpr_to_tuples', 'conll_to_tuples', 'conllu_to_tuples', 'malt_to_tuples')
+
+def page_key(cache, format, to_tuples, parse, style=None):
+  """cache key of one rendered page; the same parse drawn the same way gets
+  the same key, in any spacing where spacing doesn't matter"""
+  ext = 'svg' if format in BUILTIN_FORMATS else format
+  name = to_tuples.__name__
+  if name in SPACING_INSENSITIVE:
+    parse = normalize_parse(parse)
+  return cache.key(ext, name, parse, style or style_key())
+
+def render_parses(jobs, format='pdf', workers=None, cache=None, profile=None, errors=None, lookup=True):
+  """jobs: iterable of (to_tuples, parse_string).  Yields the rendered pages
+  in order: bytes from dot, or unicode <svg> strings for the built-in
+  formats.
+  Pages already in the cache (default: CACHE) aren't rendered again.
+  profile: a Profile (default: PROFILE) to record per-sentence timings in.
+  errors: list to append {'page': index, ...RenderError.info()} to for
+  each page dot couldn't render or its converter couldn't read; those get
+  a Placeholder, which isn't cached, and the rest still come out.
+  lookup=False: the caller already knows the pages aren't in the cache, so
+  they're only stored there"""
+  cache = cache or CACHE
+  profile = profile or PROFILE
+  builtin = format in BUILTIN_FORMATS
+  style = style_key()
+  keys = collections.deque()   # cache key per page to store, None for hits
+  sentences = collections.deque()
+  def pages():
+    for to_tuples, parse in jobs:
+      sentence = None
+      if profile:
+        sentence = profile.sentence(converter=to_tuples.__name__, input_bytes=len(parse))
+      sentences.append(sentence)
+      key = None
+      if cache:
+        key = page_key(cache, format, to_tuples, parse, style)
+        data = cache.get(key) if lookup else None
+        if sentence is not None: sentence['cached'] = data is not None
+        if data is not None:
+          keys.append(None)
+          yield data
+          continue
+      keys.append(key)
+      try:
+        with timed(profile, 'tuples', sentence):
+          # graph_tuples is lazy; walking the tree belongs to this stage,
+          # not to dot_source
+          tuples = list(to_tuples(parse))
+      except Exception, e:
+        # a malformed parse gets a placeholder like a failed dot does, and
+        # the pages after it still come out
+        error = RenderError(to_tuples.__name__, 'unreadable', message=error_text(e))
+        if sentence is not None: sentence['error'] = error.info()
+        yield placeholder_page(error, format)
+        continue
+      if builtin:
+        with timed(profile, 'svg', sentence):
+          tuples = make_svg(tuples)
+        if sentence is not None: sentence['output_bytes'] = len(tuples)
+      yield tuples
+  rendered = pages() if builtin else render_stream(pages(), format=format, workers=workers, sentences=sentences)
+  for i,page in enumerate(rendered):
+    key = keys.popleft()
+    if isinstance(page, Placeholder):
+      if not QUIET:
+        print>>sys.stderr, "FAILED page %d: %s" % (i+1, page.error)
+      if errors is not None:
+        errors.append(dict(page.error.info(), page=i))
+    elif key:
+      cache.put(key, page.encode('utf8') if isinstance(page,unicode) else page)
+    if builtin and isinstance(page, str):
+      # cache hits (and svgs of byte string input) come back as utf8; all
+      # unicode, so stack_svgs can join them
+      page = page.decode('utf8', 'replace')
+    yield page
+
+def do_multi_jobs(jobs, format='pdf', workers=None, out=None, profile=None, errors=None):
+  """jobs: (to_tuples, parse) pairs, one per page.
+  out: file-like to write the merged PDF to, instead of a file in /tmp
+  errors: list for the pages that failed (see render_parses)"""
+  with timed(profile or PROFILE, 'render'):
+    pages = list(render_parses(jobs, format=format, workers=workers, profile=profile, errors=errors))
+  if format in BUILTIN_FORMATS:
+    return write_svgs(pages, format, out)
+  return merge_pdfs(pages, out or "/tmp/parseviz.%s_merged.pdf" % stamp(), profile=profile)
+
+def do_multi_tree(parses, to_tuples, format='pdf', workers=None, out=None, profile=None):  ##= lambda s: dot_from_tuples(graph_tuples(s))):
+  return do_multi_jobs(((to_tuples,p) for p in parses), format=format, workers=workers, out=out, profile=profile)
+
+def sexpr_to_tuples(s):
+  return lod_tuples(parse_sexpr(s))
+
+def jsent_to_tree_tuples(jsent_line):
+  return lod_tuples(parse_sexpr( jsent_record(jsent_line)['parse'] ))
 
 def is_json(s):
   try:
@@ -338,87 +1180,320 @@ def is_conll_like(lines):
     return False
   return False
 
+## Input formats.  Each one knows how to recognize itself from the first few
+## lines, how to cut the input into parses, and which tuple converters to
+## render a parse with.  Detection tries them in order.
+
+InputFormat = collections.namedtuple('InputFormat', 'name sniff split converters')
+INPUT_FORMATS = []
+
+# how many nonblank lines detection looks at
+SNIFF_LINES = 100
+
+def register_format(name, sniff, split, converters, index=None):
+  """sniff(prefix): true if the first nonblank lines look like this format.
+  split(lines): yields parse strings from an iterable of lines.
+  converters(parse, options): list of to_tuples functions for one parse.
+  index: position in detection order, default last.
+  Names must be unique; format_named finds formats by them."""
+  assert name not in [f.name for f in INPUT_FORMATS], "format %s is already registered" % name
+  fmt = InputFormat(name, sniff, split, converters)
+  INPUT_FORMATS.insert(len(INPUT_FORMATS) if index is None else index, fmt)
+  return fmt
+
+def format_named(name):
+  for fmt in INPUT_FORMATS:
+    if fmt.name==name: return fmt
+  raise KeyError(name)
+
+def sniff_format(prefix):
+  for fmt in INPUT_FORMATS:
+    if fmt.sniff(prefix): return fmt
+
+def prefix_lines(input, n=SNIFF_LINES):
+  """first n nonblank lines, without splitting up the whole input"""
+  lines = []
+  pos = 0
+  while len(lines)<n and pos<len(input):
+    end = input.find('\n', pos)
+    if end==-1: end = len(input)
+    if input[pos:end].strip():
+      lines.append(input[pos:end].rstrip('\r'))
+    pos = end+1
+  return lines
+
+def split_blocks(lines):
+  # parses separated by blank lines
+  block = []
+  for line in lines:
+    if line.strip():
+      block.append(line.rstrip('\r\n'))
+    elif block:
+      yield "\n".join(block)
+      block = []
+  if block:
+    yield "\n".join(block)
+
+def split_lines(lines):
+  # one parse per line
+  for line in lines:
+    if line.strip():
+      yield line.strip()
+
+PARENS = re.compile(r'[()]')
+NOT_PARENS = ''.join(chr(i) for i in range(256) if chr(i) not in '()')
+
+def unmatched(parens):
+  # a string of parens with the matched pairs taken out, like ")))(("
+  while '()' in parens:
+    parens = parens.replace('()', '')
+  return parens
+
+def tree_ends(line, depth):
+  """For bracketed trees spread over lines: returns the offsets just past
+  each ')' in line that brings the paren depth back to 0 (from depth at
+  the start of the line), and the depth at its end.  Only lines that are
+  split or finish a continued tree are scanned paren by paren; for the
+  rest, counting and regexes are enough."""
+  closes = line.count(')')
+  if closes < depth or not closes:
+    return [], depth + line.count('(') - closes
+  # str.translate deletes in C; the parens of utf8 are the same parens
+  parens = (line.encode('utf8') if isinstance(line,unicode) else line).translate(None, NOT_PARENS)
+  if depth:
+    # the ")))" of what's left unmatched is how far below its starting
+    # depth the line goes
+    left = unmatched(parens)
+    dip = left.count(')')
+    if dip < depth:
+      return [], depth - dip + left.count('(')
+  elif line.rstrip()[-1]==')' and parens[0]=='(' and not unmatched(parens[1:-1]):
+    # the usual line: one whole tree, its first paren matching its last
+    return [line.rindex(')')+1], 0
+  ends = []
+  for m in PARENS.finditer(line):
+    if m.group()=='(':
+      depth += 1
+    else:
+      depth -= 1
+      if depth<=0:
+        # a stray ')' ends a piece too; parse_sexpr will complain about it
+        ends.append(m.end())
+        depth = 0
+  return ends, depth
+
+def split_sexprs(lines):
+  # one tree per top-level pair of parens, however it's spread over lines
+  # (as in PTB .mrg files), or however many are on a line
+  piece = []
+  depth = 0
+  for line in lines:
+    line = line.rstrip('\r\n')
+    ends, depth = tree_ends(line, depth)
+    start = 0
+    for end in ends:
+      piece.append(line[start:end])
+      yield "\n".join(piece).strip()
+      piece = []
+      start = end
+    if piece or line[start:].strip():
+      piece.append(line[start:])
+  if piece and "".join(piece).strip():
+    yield "\n".join(piece).strip()
+
+_last_jsent = (None, None)
+
+def jsent_record(line):
+  """The JSON of a jsent line.  The last line's is kept, since each line
+  goes to jsent_converters and then to the tree and dependency converters,
+  one right after the other; that way it's decoded once."""
+  global _last_jsent
+  last_line, record = _last_jsent
+  if line is not last_line:
+    record = json.loads(line.rsplit('\t',1)[-1])
+    _last_jsent = (line, record)
+  return record
+
+def sniff_jsent(prefix):
+  s = prefix[0].rsplit('\t',1)[-1].strip()
+  if not (s.startswith('{') and s.endswith('}')): return False
+  try:
+    d = jsent_record(prefix[0])
+  except ValueError:
+    return False
+  return 'parse' in d or 'deps' in d or 'deps_cc' in d
+
+def jsent_converters(parse, options):
+  try:
+    d = jsent_record(parse)
+  except ValueError:
+    # not JSON; the tree converter says so on its page
+    return [jsent_to_tree_tuples]
+  convs = []
+  if 'parse' in d:
+    convs.append(jsent_to_tree_tuples)
+  if ('deps' in d or 'deps_cc' in d) and not options.get('tree_only'):
+    convs.append(jsent_to_dep_tuples)
+  return convs
+
+CONLLU_ID = re.compile(r'\d+([-.]\d+)?\t')
+
+def sniff_conllu(prefix):
+  # comment lines, or multiword/empty-node ids like 1-2 and 1.1
+  rows = [L for L in prefix if not L.startswith('#')]
+  if not rows or not all(CONLLU_ID.match(L) for L in rows): return False
+  return len(rows)<len(prefix) or any(not L.split('\t')[0].isdigit() for L in rows)
+
+def conllu_to_tuples(conllu):
+  # plain word lines are CoNLL-X columns as far as conll_to_tuples cares
+  return conll_to_tuples("\n".join(L for L in conllu.split("\n") if L.split('\t')[0].isdigit()))
+
+def one_converter(to_tuples):
+  return lambda parse, options: [to_tuples]
+
+register_format('conllu', sniff_conllu, split_blocks, one_converter(conllu_to_tuples))
+register_format('conll', is_conll_like, split_blocks, one_converter(conll_to_tuples))
+register_format('jsent', sniff_jsent, split_lines, jsent_converters)
+# tab-separated but not numbered: still CoNLL-ish
+register_format('conll_tab', lambda prefix: '\t' in prefix[0], split_blocks, one_converter(conll_to_tuples))
+register_format('sexpr', lambda prefix: re.search(r'[\(\)]', prefix[0]) and is_balanced(prefix[0]),
+    split_sexprs, one_converter(sexpr_to_tuples))
+register_format('malt', lambda prefix: all(('/' in L and '\t' not in L) for L in prefix),
+    split_lines, one_converter(malt_to_tuples))
+# (potentially multiline) sexprs
+register_format('sexpr_multiline', lambda prefix: True, split_sexprs, one_converter(sexpr_to_tuples))
+
 def detect_type(input):
   """return: (format, [parses_as_strings])"""
   input = input.strip()
-  lines = input.split("\n")
-  lines = [l for l in lines if l.strip()]
-
-  if is_conll_like(lines):
-    format = 'conll'
-    parts = re.split(r'\n[ \t\r]*\n', input)
-    return format,parts
-
-  if is_json(lines[0].split('\t')[-1]):
-    d = json.loads( lines[0].split('\t')[-1] )
-    if 'parse' in d or 'deps' in d or 'deps_cc' in d:
-      return 'jsent', lines
-
-  elif '\t' in lines[0]:
-    if is_json(lines[0].split('\t')[-1]):
-      if '-tree' in sys.argv:
-        return 'sexpr', [json.loads(L.split('\t')[-1])['parse'] for L in lines]
-      else:
-        return 'jsent', lines
-    else:
-      format = 'conll'
-      parts = re.split(r'\n[ \t\r]*\n', input)
-      return format,parts
-  if re.search(r'[\(\)]', lines[0]) and is_balanced(lines[0]):
-    # one sexpr per line
-    return 'sexpr', lines
-  if all(('/' in L and '\t' not in L) for L in lines[:100]):
-    return 'malt', lines
-  # single (potentially multiline) sexpr
-  return 'sexpr', [input]
-
-def smart_process(input, output_format):
+  prefix = prefix_lines(input)
+  if not prefix: return None, []
+  fmt = sniff_format(prefix)
+  return fmt.name, list(fmt.split(input.split("\n")))
+
+def input_jobs(input_format, parses, options=None):
+  """(to_tuples, parse) pairs to render, for parses of the given format"""
+  if input_format is None: return
+  fmt = format_named(input_format)
+  for parse in parses:
+    for to_tuples in fmt.converters(parse, options or {}):
+      yield to_tuples, parse
+
+def stream_parses(lines, prefix_size=SNIFF_LINES):
+  """lines: iterable of input lines, e.g. sys.stdin.
+  Detects the format from the first prefix_size nonblank lines only, then
+  yields (format, parse_string) one parse at a time."""
+  lines = iter(lines)
+  seen = []
+  prefix = []
+  for line in lines:
+    seen.append(line)
+    if line.strip():
+      prefix.append(line.rstrip('\r\n'))
+      if len(prefix)>=prefix_size: break
+  if not prefix: return
+  fmt = sniff_format(prefix)
+  for parse in fmt.split(itertools.chain(seen, lines)):
+    yield fmt.name, parse
+
+def stream_jobs(parses, options=None):
+  """(format, parse) pairs -> (to_tuples, parse) pairs for render_parses"""
+  for input_format, parse in parses:
+    for to_tuples in format_named(input_format).converters(parse, options or {}):
+      yield to_tuples, parse
+
+def stream_process(lines, output_format, workers=None, out=None, options=None, profile=None, errors=None):
+  """Like smart_process, but reads the input lazily and writes each page as
+  soon as it is rendered, so memory doesn't grow with the input size.
+  out: file-like to write the PDF or HTML to, instead of a file in /tmp"""
+  assert output_format in ('pdf','html'), "streaming supports pdf and html output"
+  profile = profile or PROFILE
+  pages = render_parses(stream_jobs(stream_parses(lines), options), format=output_format,
+      workers=workers, profile=profile, errors=errors)
+
+  if output_format=='html':
+    output = out or "/tmp/parseviz.%s_merged.html" % stamp()
+    with output_file(output) as f:
+      html_pages(f, pages)
+    return output
+
+  output = out or "/tmp/parseviz.%s_merged.pdf" % stamp()
+  writer = pdfmerge.PdfWriter(output)
+  for i,page in enumerate(pages):
+    with timed(profile, 'merge'):
+      writer.add_pdf(mergeable_pdf(page, profile))
+    if not QUIET:
+      print "PAGE", i+1
+      sys.stdout.flush()
+  writer.close()
+  return output
+
+def smart_process(input, output_format, workers=None, out=None, options=None, profile=None, errors=None):
+  """options: dict of input options; 'tree_only' skips the dependencies
+  of jsent input.
+  profile: a Profile (default: PROFILE) to record timings in.
+  errors: list to append a dict to for each page that couldn't be
+  rendered and got a placeholder (see render_parses)"""
   # always do multitree these days
-  assert output_format=='pdf', "non-pdf doesn't work now, needs refactoring here"
-
-  input_format, parse_strings = detect_type(input)
-
-  if input_format=='jsent':
-    # only handle singletons for now
-    print>>sys.stderr, parse_strings
-    xx = json.loads(parse_strings[0])
-    has_deps = ('deps' in xx or 'deps_cc' in xx)
-    has_cparse= ('parse' in xx)
-    if has_deps:
-      dep_pdf = do_multi_tree(parse_strings, jsent_to_dep_tuples)
-    if has_cparse:
-      c_pdf = do_multi_tree(parse_strings, lambda s: graph_tuples(parse_sexpr( json.loads(s)['parse'] )))
-    if has_deps and has_cparse:
-      finalout = "/tmp/parseviz.%s_merged.pdf" % stamp()
-      os.system("gs -q -dNOPAUSE -dBATCH -sDEVICE=pdfwrite -sOutputFile=%s %s" % 
-          (finalout, ' '.join([c_pdf,dep_pdf])))
-      return finalout
-    elif has_deps:
-      return dep_pdf
-    elif has_cparse:
-      return c_pdf
-    else:
-      return "WTF"
+  assert output_format=='pdf' or output_format in BUILTIN_FORMATS, \
+      "png/eps don't work now, needs refactoring here"
 
-  else:
-    if input_format=='sexpr':
-      converter = lambda s: graph_tuples(parse_sexpr(s))
-    elif input_format=='conll':
-      converter = conll_to_tuples
-    elif input_format=='malt':
-      converter = malt_to_tuples
-    return do_multi_tree(parse_strings, converter)
+  with timed(profile or PROFILE, 'detect'):
+    input_format, parse_strings = detect_type(input)
+
+  # jsent records give a tree page and a dependency page each, adjacent
+  jobs = input_jobs(input_format, parse_strings, options)
+  return do_multi_jobs(jobs, format=output_format, workers=workers, out=out, profile=profile, errors=errors)
 
 if __name__=='__main__':
-  input = sys.stdin.read().strip()
   output_format = 'png' if '-png' in sys.argv else \
             'eps' if '-eps' in sys.argv else \
             'pdf' if '-pdf' in sys.argv else \
             'html' if '-html' in sys.argv else \
+            'svg' if '-svg' in sys.argv else \
             'pdf' if sys.platform=='darwin' else \
             'pdf'
-  output_filename = smart_process(input, output_format)
-  print "OUTPUT",output_filename
+  workers = int(sys.argv[sys.argv.index('-j')+1]) if '-j' in sys.argv else None
+  # -stdout: write the PDF itself to stdout, and nothing else
+  out = sys.stdout if '-stdout' in sys.argv else None
+  if out: QUIET = True
+  if '-cache' in sys.argv:
+    import rendercache
+    CACHE = rendercache.RenderCache(sys.argv[sys.argv.index('-cache')+1])
+  # --profile FILE: write stage and per-sentence timings there as JSON
+  if '--profile' in sys.argv:
+    PROFILE = Profile()
+  # -theme NAME: label colors from themes/NAME.json (or a path)
+  if '-theme' in sys.argv:
+    use_theme(sys.argv[sys.argv.index('-theme')+1])
+  # -maxnodes N, -maxdepth N: draw the subtrees past that as summary nodes
+  if '-maxnodes' in sys.argv:
+    MAX_NODES = int(sys.argv[sys.argv.index('-maxnodes')+1])
+  if '-maxdepth' in sys.argv:
+    MAX_DEPTH = int(sys.argv[sys.argv.index('-maxdepth')+1])
+  # -timeout SECONDS, -maxmem MB: limits on each dot process
+  if '-timeout' in sys.argv:
+    RENDER_TIMEOUT = float(sys.argv[sys.argv.index('-timeout')+1])
+  if '-maxmem' in sys.argv:
+    RENDER_MEMORY_MB = int(sys.argv[sys.argv.index('-maxmem')+1])
+  # -tree: for jsent input, only draw the constituency trees
+  options = {'tree_only': '-tree' in sys.argv}
+  errors = []
+  if '-stream' in sys.argv:
+    output_filename = stream_process(iter(sys.stdin.readline, ''), output_format,
+        workers=workers, out=out, options=options, errors=errors)
+  else:
+    input = sys.stdin.read().strip()
+    output_filename = smart_process(input, output_format, workers=workers, out=out, options=options, errors=errors)
+  if not out:
+    print "OUTPUT",output_filename
+  if CACHE:
+    print>>sys.stderr, "CACHE hits=%(hits)s misses=%(misses)s bytes=%(bytes)s" % CACHE.stats()
+  if PROFILE:
+    with open(sys.argv[sys.argv.index('--profile')+1], 'w') as f:
+      json.dump(PROFILE.report(), f, indent=1, sort_keys=True)
   # open_file(output_filename)
+  if errors:
+    sys.exit(1)
 
 # vim: sw=2:sts=2
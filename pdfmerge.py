@@ -0,0 +1,244 @@
+"""
+pdfmerge.py
+
+Concatenates PDF pages into one document without Ghostscript.  The pages'
+objects are copied byte for byte (only object numbers are rewritten), so
+nothing gets re-interpreted or re-rasterized, and pages can be appended one
+at a time as they come out of dot.
+
+Handles the classic cross-reference-table PDFs that dot/cairo write (and
+the ones this module writes).  Compressed object streams aren't supported;
+load raises PdfError for those, before anything is written, and the caller
+can rewrite the page with gs.
+"""
+
+from __future__ import with_statement
+import re
+
+class PdfError(Exception): pass
+
+OBJ_RE = re.compile(r'(\d+)\s+(\d+)\s+obj\b')
+REF_RE = re.compile(r'(\d+)\s+(\d+)\s+R\b')
+STREAM_RE = re.compile(r'\bstream\r?\n')
+# page attributes that may live on a /Pages node instead of the page itself
+INHERITABLE = ['MediaBox','CropBox','Rotate','Resources']
+
+def read_xref(data):
+  """returns {objnum: offset} and the trailer dict text"""
+  m = re.search(r'startxref\s+(\d+)', data[-1024:])
+  if not m: raise PdfError("no startxref")
+  offsets = {}
+  trailers = []
+  pos = int(m.group(1))
+  seen = set()
+  while pos is not None and pos not in seen:
+    seen.add(pos)
+    if not data.startswith('xref', pos):
+      raise PdfError("no classic xref table (compressed xref streams aren't supported)")
+    tpos = data.find('trailer', pos)
+    if tpos == -1: raise PdfError("no trailer")
+    lines = data[pos+4:tpos].split()
+    i = 0
+    while i < len(lines):
+      start, count = int(lines[i]), int(lines[i+1])
+      i += 2
+      for k in range(count):
+        offset, gen, kind = lines[i:i+3]
+        i += 3
+        # offset 0 can't be an object; some writers use it for free entries
+        if kind == 'n' and int(offset) and start+k not in offsets:
+          offsets[start+k] = int(offset)
+    trailer = data[tpos+7 : data.find('startxref', tpos)]
+    trailers.append(trailer)
+    prev = re.search(r'/Prev\s+(\d+)', trailer)
+    pos = int(prev.group(1)) if prev else None
+  return offsets, trailers[0]
+
+class SourcePdf(object):
+  """Random access to the objects of one PDF file held in memory."""
+  def __init__(self, data):
+    if not data.startswith('%PDF'): raise PdfError("not a PDF")
+    self.data = data
+    self.offsets, self.trailer = read_xref(data)
+    self.cache = {}
+
+  def get(self, num):
+    """returns (dict_text, stream_bytes or None) for an object number"""
+    if num in self.cache: return self.cache[num]
+    data = self.data
+    m = OBJ_RE.match(data, self.offsets[num])
+    if not m or int(m.group(1)) != num:
+      raise PdfError("bad xref offset for object %d" % num)
+    start = m.end()
+    end = data.find('endobj', start)
+    s = STREAM_RE.search(data, start, end if end!=-1 else len(data))
+    if s is None:
+      ret = (data[start:end].strip(), None)
+    else:
+      text = data[start:s.start()].strip()
+      length = re.search(r'/Length\s+(\d+)(\s+(\d+)\s+R\b)?', text)
+      if not length: raise PdfError("stream without /Length in object %d" % num)
+      if length.group(2):
+        n = int(self.get(int(length.group(1)))[0])
+      else:
+        n = int(length.group(1))
+      ret = (text, data[s.end() : s.end()+n])
+    self.cache[num] = ret
+    return ret
+
+  def load(self):
+    """reads the page tree and every object up front, so copying them
+    can't fail halfway; returns self"""
+    self.tree = self.page_tree()
+    for num in self.offsets: self.get(num)
+    return self
+
+  def ref(self, text, key):
+    m = re.search(r'/%s\s+(\d+)\s+\d+\s+R\b' % key, text)
+    return int(m.group(1)) if m else None
+
+  def page_tree(self):
+    """returns (page objnums in document order, set of /Pages node objnums,
+    {page objnum: inherited attribute text})"""
+    root = self.ref(self.trailer, 'Root')
+    if root is None: raise PdfError("no /Root")
+    pages = []
+    nodes = set()
+    inherited = {}
+    stack = [(self.ref(self.get(root)[0], 'Pages'), {})]
+    while stack:
+      num, inherit = stack.pop()
+      text, stream = self.get(num)
+      if re.search(r'/Type\s*/Pages\b', text):
+        nodes.add(num)
+        inherit = dict(inherit)
+        for key in INHERITABLE:
+          v = re.search(r'/%s\s*(\[[^\]]*\]|\d+\s+\d+\s+R\b|-?\d+)' % key, text)
+          if v: inherit[key] = v.group(1)
+        kids = re.search(r'/Kids\s*\[([^\]]*)\]', text)
+        kids = [int(k.group(1)) for k in REF_RE.finditer(kids.group(1))] if kids else []
+        for kid in reversed(kids):
+          stack.append((kid, inherit))
+      else:
+        pages.append(num)
+        inherited[num] = inherit
+    return pages, nodes, inherited
+
+class PdfWriter(object):
+  """Writes a multi-page PDF to a file-like object as pages are added.
+  Object 1 is the catalog and object 2 the page tree; both are written by
+  close(), everything else as soon as it's added.  Never seeks, so the
+  output can be stdout or an HTTP response."""
+
+  def __init__(self, out):
+    if isinstance(out, basestring):
+      out = open(out, 'wb')
+      self.owns_out = True
+    else:
+      self.owns_out = False
+    self.out = out
+    self.pos = 0
+    self.offsets = {}
+    self.next_num = 3
+    self.kids = []
+    self.write('%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+
+  def write(self, s):
+    self.out.write(s)
+    self.pos += len(s)
+
+  def write_obj(self, num, text, stream=None):
+    self.offsets[num] = self.pos
+    self.write('%d 0 obj\n%s\n' % (num, text))
+    if stream is not None:
+      self.write('stream\n')
+      self.write(stream)
+      self.write('\nendstream\n')
+    self.write('endobj\n')
+
+  def add_pdf(self, pdf):
+    """pdf: filename, file contents or a SourcePdf from load().  Appends all
+    of its pages."""
+    # read everything before writing anything, so a bad input can't leave
+    # half an object in the output
+    src = pdf if isinstance(pdf, SourcePdf) else load(pdf)
+    pages, nodes, inherited = src.tree
+    root = src.ref(src.trailer, 'Root')
+    # copy everything but the old catalog and page tree nodes
+    renum = {root: 1}
+    for num in nodes: renum[num] = 2
+    for num in sorted(src.offsets):
+      if num not in renum:
+        renum[num] = self.next_num
+        self.next_num += 1
+    def fix_refs(text):
+      def sub(m):
+        n = int(m.group(1))
+        return '%d 0 R' % renum[n] if n in renum else 'null'
+      return REF_RE.sub(sub, text)
+    for num in sorted(src.offsets):
+      if num == root or num in nodes: continue
+      text, stream = src.get(num)
+      if num in inherited:
+        extra = ''.join(' /%s %s' % (k,v) for k,v in sorted(inherited[num].items())
+            if '/'+k not in text)
+        if extra:
+          text = text[:text.rindex('>>')] + extra + ' >>'
+      self.write_obj(renum[num], fix_refs(text), stream)
+    self.kids += [renum[p] for p in pages]
+
+  def close(self):
+    self.write_obj(2, '<< /Type /Pages /Kids [ %s ] /Count %d >>' % (
+        ' '.join('%d 0 R' % k for k in self.kids), len(self.kids)))
+    self.write_obj(1, '<< /Type /Catalog /Pages 2 0 R >>')
+    xref_pos = self.pos
+    size = self.next_num
+    self.write('xref\n0 %d\n0000000000 65535 f \n' % size)
+    for num in range(1, size):
+      if num in self.offsets:
+        self.write('%010d 00000 n \n' % self.offsets[num])
+      else:
+        self.write('0000000000 65535 f \n')
+    self.write('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref_pos))
+    if self.owns_out:
+      self.out.close()
+    else:
+      self.out.flush()
+
+def text_page(lines, width=612):
+  """a one-page PDF of a few lines of Helvetica, e.g. a note standing in
+  for a page that couldn't be rendered"""
+  from cStringIO import StringIO
+  def escape(line):
+    return line.replace('\\','\\\\').replace('(','\\(').replace(')','\\)')
+  height = 40 + 16*len(lines)
+  content = 'BT /F1 12 Tf 16 TL 20 %d Td %s ET' % (height-28,
+      ' '.join('(%s) Tj T*' % escape(line) for line in lines))
+  out = StringIO()
+  w = PdfWriter(out)
+  w.write_obj(3, '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>'
+      % (width, height))
+  w.write_obj(4, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+  w.write_obj(5, '<< /Length %d >>' % len(content), content)
+  w.next_num = 6
+  w.kids.append(3)
+  w.close()
+  return out.getvalue()
+
+def load(pdf):
+  """pdf: filename or file contents -> a SourcePdf with everything read"""
+  if not pdf.startswith('%PDF'):
+    with open(pdf, 'rb') as f:
+      pdf = f.read()
+  return SourcePdf(pdf).load()
+
+def merge(inputs, output):
+  """inputs: PDF filenames, contents or loaded SourcePdfs, in page order.
+  output: filename or file-like.  Every input is read before the output is
+  opened, so a bad one raises PdfError with nothing written."""
+  sources = [f if isinstance(f, SourcePdf) else load(f) for f in inputs]
+  w = PdfWriter(output)
+  for src in sources:
+    w.add_pdf(src)
+  w.close()
+  return output
@@ -0,0 +1,102 @@
+"""
+rendercache.py
+
+Content-addressed cache of rendered pages, one file per entry, shared by
+the command line and the CGI.  Entries are named by a hash of whatever the
+caller says determines the output (the parse, output format, colors...),
+so unchanged or repeated sentences are rendered once.
+
+The directory is capped at max_bytes: when it grows past that, the least
+recently used files (by mtime, which a hit bumps) are deleted.  Writes go
+through a temp name and a rename, so several processes can share it.
+"""
+
+from __future__ import with_statement
+import os,hashlib,threading
+
+class RenderCache(object):
+  def __init__(self, directory, max_bytes=200*1024*1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.size = None   # bytes on disk, found by scanning on the first put
+    self.lock = threading.Lock()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def key(self, ext, *parts):
+    """entry name for the given parts, e.g. key('pdf', parse, style)"""
+    h = hashlib.sha1()
+    for part in parts:
+      h.update(part.encode('utf8') if isinstance(part,unicode) else part)
+      h.update('\0')
+    return "%s.%s" % (h.hexdigest(), ext)
+
+  def path(self, key):
+    return os.path.join(self.directory, key)
+
+  def get(self, key):
+    """returns the cached bytes, or None"""
+    try:
+      with open(self.path(key), 'rb') as f:
+        data = f.read()
+      os.utime(self.path(key), None)
+    except (IOError, OSError):
+      with self.lock: self.misses += 1
+      return None
+    with self.lock: self.hits += 1
+    return data
+
+  def has(self, key):
+    """like get, for when the caller only needs path(key)"""
+    try:
+      os.utime(self.path(key), None)
+    except OSError:
+      with self.lock: self.misses += 1
+      return False
+    with self.lock: self.hits += 1
+    return True
+
+  def put(self, key, data):
+    tmp = "%s.%s.%s.tmp" % (self.path(key), os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.rename(tmp, self.path(key))
+    with self.lock:
+      if self.size is None:
+        self.size = self.disk_usage()
+      else:
+        self.size += len(data)
+      if self.size > self.max_bytes:
+        self.evict()
+
+  def disk_usage(self):
+    total = 0
+    for name in os.listdir(self.directory):
+      try: total += os.path.getsize(os.path.join(self.directory, name))
+      except OSError: pass
+    return total
+
+  def evict(self):
+    """deletes least recently used entries down to 90% of max_bytes"""
+    entries = []
+    for name in os.listdir(self.directory):
+      p = os.path.join(self.directory, name)
+      try:
+        st = os.stat(p)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, p))
+    entries.sort()
+    self.size = sum(e[1] for e in entries)
+    for mtime, size, p in entries:
+      if self.size <= self.max_bytes * 0.9: break
+      try:
+        os.remove(p)
+        self.size -= size
+      except OSError:
+        pass
+
+  def stats(self):
+    return {'hits':self.hits, 'misses':self.misses, 'bytes':self.size}
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+sentindex.py
+
+Random access to the sentences of a big parse file.  The file is memory
+mapped and scanned once for where each parse starts and ends, cut the way
+parseviz's format detection cuts it: blank lines between CoNLL blocks, one
+line per malt or jsent parse, and top-level parens for sexpr trees, however
+they're spread over lines.  After that, getting sentence 48213 reads those bytes
+and nothing else.
+
+The offsets are saved next to the file, as FILE.pvidx, and reused until the
+file's size or mtime changes.
+
+  ./sentindex.py FILE [FIRST[-LAST]] [-pdf|-html|-svg] [-tree]
+
+renders sentences FIRST..LAST (counting from 0, both included, as batch.py
+numbers its pages), or with no range prints how many there are.  From
+Python:
+
+  index = sentindex.SentenceIndex("treebank.conll")
+  parses = index.parses(48213, 48221)
+"""
+
+from __future__ import with_statement
+import sys,os,re,mmap,json
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import parseviz
+
+INDEX_SUFFIX = '.pvidx'
+INDEX_MAGIC = 'parseviz-index 2'
+
+# a parse is a run of nonblank lines, or one nonblank line
+BLOCK_RE = re.compile(r'^[ \t\r\f\v]*\S.*(?:\n[ \t\r\f\v]*\S.*)*', re.M)
+LINE_RE = re.compile(r'^[ \t\r\f\v]*\S.*', re.M)
+
+def split_kind(fmt):
+  if fmt.split is parseviz.split_blocks: return 'blocks'
+  if fmt.split is parseviz.split_lines: return 'lines'
+  if fmt.split is parseviz.split_sexprs: return 'sexprs'
+  raise ValueError("can't index %s input" % fmt.name)
+
+def scan_offsets(data, kind):
+  """array of start, end byte offsets of each parse in data (a string or
+  mmap), alternating"""
+  if kind=='sexprs':
+    return sexpr_offsets(data)
+  offsets = array('l')
+  for m in (BLOCK_RE if kind=='blocks' else LINE_RE).finditer(data):
+    offsets.append(m.start())
+    offsets.append(m.end())
+  return offsets
+
+def sexpr_offsets(data):
+  # the same cuts as parseviz.split_sexprs, as byte offsets
+  offsets = array('l')
+  depth = 0
+  start = None
+  pos = 0
+  while pos < len(data):
+    end = data.find('\n', pos)
+    if end==-1: end = len(data)
+    line = data[pos:end]
+    ends, depth = parseviz.tree_ends(line, depth)
+    col = 0
+    for e in ends:
+      offsets.extend([pos+col if start is None else start, pos+e])
+      start = None
+      col = e
+    if start is None and line[col:].strip():
+      start = pos+col
+    pos = end+1
+  if start is not None:
+    offsets.extend([start, len(data)])
+  return offsets
+
+class SentenceIndex(object):
+  """The parses of one file, by number.  Builds the index on first use of
+  the file, or loads the saved one."""
+  def __init__(self, path, save=True):
+    self.path = path
+    self.index_path = path + INDEX_SUFFIX
+    self.file = open(path, 'rb')
+    st = os.fstat(self.file.fileno())
+    self.stamp = {'size': st.st_size, 'mtime': st.st_mtime}
+    # mmap can't map an empty file
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else ''
+    if not self.load():
+      self.build()
+      if save: self.save()
+
+  def build(self):
+    prefix = parseviz.prefix_lines(self.data)
+    fmt = parseviz.sniff_format(prefix) if prefix else None
+    self.format = fmt and fmt.name
+    self.kind = split_kind(fmt) if fmt else None
+    self.offsets = scan_offsets(self.data, self.kind) if fmt else array('l')
+
+  def load(self):
+    """reads the saved index, if it's there and for this version of the file"""
+    try:
+      with open(self.index_path, 'rb') as f:
+        if f.readline().strip() != INDEX_MAGIC: return False
+        header = json.loads(f.readline())
+        if header['stamp'] != self.stamp or header['itemsize'] != array('l').itemsize:
+          return False
+        offsets = array('l')
+        offsets.fromfile(f, 2*header['count'])
+    except (IOError, OSError, ValueError, KeyError, EOFError):
+      return False
+    self.format, self.kind, self.offsets = header['format'], header['kind'], offsets
+    return True
+
+  def save(self):
+    # through a temp name, like rendercache, for other processes reading it
+    tmp = "%s.%d.tmp" % (self.index_path, os.getpid())
+    try:
+      with open(tmp, 'wb') as f:
+        print>>f, INDEX_MAGIC
+        print>>f, json.dumps({'stamp': self.stamp, 'format': self.format, 'kind': self.kind,
+            'count': len(self), 'itemsize': self.offsets.itemsize})
+        self.offsets.tofile(f)
+      os.rename(tmp, self.index_path)
+    except (IOError, OSError):
+      # read-only directory: the index just isn't kept
+      if os.path.exists(tmp): os.remove(tmp)
+
+  def __len__(self):
+    return len(self.offsets)//2
+
+  def parse(self, i):
+    """parse i as a string, the same as detect_type would give it"""
+    if i < 0: i += len(self)
+    if not 0 <= i < len(self): raise IndexError(i)
+    text = self.data[self.offsets[2*i]:self.offsets[2*i+1]]
+    if self.kind=='blocks':
+      return "\n".join(L.rstrip('\r') for L in text.split("\n"))
+    if self.kind=='sexprs':
+      return "\n".join(L.rstrip('\r') for L in text.split("\n")).strip()
+    return text.strip()
+
+  def parses(self, start, stop=None):
+    """parses start..stop-1"""
+    stop = len(self) if stop is None else min(stop, len(self))
+    return [self.parse(i) for i in xrange(start, stop)]
+
+  def close(self):
+    if self.data: self.data.close()
+    self.file.close()
+
+def render_sentences(path, start, stop, output_format='pdf', workers=None, out=None, options=None, profile=None):
+  """renders parses start..stop-1 of the file like smart_process does for
+  a whole input; returns the output filename"""
+  index = SentenceIndex(path)
+  try:
+    jobs = parseviz.input_jobs(index.format, index.parses(start, stop), options)
+    return parseviz.do_multi_jobs(jobs, format=output_format, workers=workers, out=out, profile=profile)
+  finally:
+    index.close()
+
+def parse_range(s):
+  """"48213-48220" or "48213" -> (start, stop)"""
+  first, _, last = s.partition('-')
+  return int(first), int(last or first)+1
+
+if __name__=='__main__':
+  args = [a for a in sys.argv[1:] if not a.startswith('-')]
+  if not args:
+    print>>sys.stderr, __doc__
+    sys.exit(1)
+  if len(args)==1:
+    index = SentenceIndex(args[0])
+    print "%d %s parses" % (len(index), index.format)
+    sys.exit(0)
+  output_format = 'html' if '-html' in sys.argv else 'svg' if '-svg' in sys.argv else 'pdf'
+  start, stop = parse_range(args[1])
+  print "OUTPUT", render_sentences(args[0], start, stop, output_format,
+      options={'tree_only': '-tree' in sys.argv})
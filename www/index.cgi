@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import cgi,os,sys,urllib,md5
+from __future__ import with_statement
+import cgi,os,sys,urllib
 import cgitb;cgitb.enable()
 from pprint import pprint
 from copy import copy,deepcopy
@@ -8,65 +9,20 @@ from cgiutil import *
 
 # os.environ['PATH'] = '/usr/local/bin:' + os.environ['PATH']
 
-def safehtml(x):
-  return cgi.escape(str(x),quote=True)
-
-def get_md5(s):
-  m = md5.new()
-  m.update(s)
-  return m.hexdigest()
-
-import parseviz
+import parseviz, rendercache, viewer
 parseviz.QUIET = True
-
-print "Content-Type: text/html\n"
-print """ <!-- tag soup 4ever -->
-<title>ParseViz</title>
-<style>
-body{font-family:"Helvetica Neue",arial, sans-serif; font-size:10pt; }
-td  {font-family:"helvetica neue",arial, sans-serif; font-size:10pt; }
-form {padding-top:0;padding-bottom:0; margin-top:0;margin-bottom:0;}
-</style>"""
-print """<script src=http://ajax.googleapis.com/ajax/libs/jquery/1.4.1/jquery.min.js></script>"""
-#print """<script src=autoHeight.js></script>"""
-print """<script>
-examples = {}
-
-function do_example(name) {
-  $('textarea').val(examples[name])
-  $('form#parseform').submit()
-}
-
-function resize_viewer() {
-  if ($('object').length > 0) {
-    var newheight = $(window).height() - $('#topstuff').height() - $('#topstuff').offset().top - 5;
-    $('object').attr('height', newheight);
-  }
-}
-
-$(document).ready(function(){
-
-  $(window).resize(resize_viewer);
-  resize_viewer();
-  //setInterval(resize_viewer, 200);
-
-  if ($('[name=parsedata]').text().length == 0) {
-    $('input[name=s]').focus();
-  }
-})
-
-%s
-
-</script>""" % (open("examples.js").read())
-print "<div id=topstuff>" ## topstuff
-print """<div>
-<span style="font-size:130%; font-weight:bold"><a href=.>ParseViz</a> - parse visualization</span>
-<small>
-&nbsp; <a href=http://github.com/brendano/parseviz>code and documentation on github</a>  
-by <a href=http://brenocon.com>brendan</a>
-</small>
-</div>
-"""
+parseviz.WORKERS = 4
+# a sentence dot takes longer than this on gets a placeholder instead, so
+# one bad input can't hold a worker
+parseviz.RENDER_TIMEOUT = 20
+parseviz.RENDER_MEMORY_MB = 1024
+# bigger trees get subtrees summarized, expanded on the page by clicking
+parseviz.MAX_NODES = 250
+# both single-sentence pages and whole documents; served from here too
+cache = rendercache.RenderCache("output", max_bytes=500*1024*1024)
+parseviz.CACHE = cache
+# file to log render timings to (see parseviz.Profile), e.g. "output/profile.log"
+profile_log = None
 
 # import parsezoo
 
@@ -74,9 +30,22 @@ opts = Opts(
     opt('s', default=""),
     # opt('parser', default="SP_DepSD_cc", values=[p['name'] for p in parsezoo.parsers]),
     opt('parsedata', default=""),
+    opt('panels', default=""),   # just the panel list, as JSON
+    opt('start', default=0),     # ... of panels start..start+count
+    opt('count', default=viewer.PANELS_PER_PAGE),
+    opt('pdf', default=""),      # the whole input as one PDF
 )
 
 parsedata = opts.parsedata
+
+if opts.panels:
+  print "Content-Type: application/json\n"
+  panels, more = viewer.render_panels(cache, parsedata, opts.start, opts.count, profile_log)
+  print viewer.panels_json(panels, more, cache)
+  sys.exit(0)
+
+print "Content-Type: text/html\n"
+print viewer.page_head(open("examples.js").read())
 # if not parsedata and opts.s:
 #   parsedata = parsezoo.parse_sentence(opts.s, opts.parser)
 
@@ -89,53 +58,13 @@ if False:
   print "<input type=submit>"
   print "</form>"
 
-print "<form id=parseform action=. method=post>"
-
-#print "<input name=sentence>
-print """Enter parse(s). 
-Examples: 
-  <small>
-<a href="javascript:do_example('tree1')">[tree]</a>
-<a href="javascript:do_example('tree_mobydick')">[big tree: melville]</a>
-<a href="javascript:do_example('dep1')">[deps]</a>
-<a href="javascript:do_example('many_trees')">[many trees]</a>
-<a href="javascript:do_example('many_deps')">[many deps]</a>
-<a href="javascript:do_example('malt')">[malt-format deps]</a>
-<a href="javascript:do_example('jsent')">[jsent-format tree/deps]</a>
-</small>
-
-  <br>"""
-print """
-<textarea name=parsedata rows=6 cols=100 style="font-family: helvetica,arial, sans-serif; font-size:9pt; width:90%%">%s</textarea>
-<br>
-<input type=submit>
-</form>
-""" % safehtml(str(parsedata))
-
-if parsedata:
-  hash = get_md5(parsedata)
-  final = "output/%s.pdf" % hash
-  if not os.path.exists(final):
-    pdf_filename = parseviz.smart_process(parsedata, 'pdf')
-    os.system("mv %s %s" % (pdf_filename, final))
-    os.system("rm -f /tmp/parseviz.*")
-  # url = "http://www.ark.cs.cmu.edu/parseviz/%s" % final
-  # http://docs.google.com/viewer has minimal info
-
-  # g_url = "http://docs.google.com/viewer?url=%s" % urllib.quote(url)
-  print "<a target=_blank href='%s'>[Open in new window]</a>" % final
-  # print "<a target=_blank href='%s'>[Google Docs link]</a>" % g_url
-  # print " and reload if below is stuck "
-  print "</div>" ## topstuff
-  # print "<iframe src='%s&embedded=true' style='width:100%%' width=600 height=400 style='border:none'></iframe>" % g_url
-
-  print r"""
-  <object data="{final}" type="application/pdf" width="100%" height=400>
-    <p><a target=_blank href='{final}'>[Open in new window]</a>
-  </object>
-  """.format(**locals())
+print viewer.page_form(parsedata)
 
+if parsedata and opts.pdf:
+  final = viewer.render_document(cache, parsedata, profile_log)
+  print viewer.page_result(final, cache)
+elif parsedata:
+  panels, more = viewer.render_panels(cache, parsedata, profile_log=profile_log)
+  print viewer.page_panels(panels, more, cache)
 
   # print "<script>resize_viewer()</script>"
-
-
@@ -0,0 +1 @@
+../pdfmerge.py
\ No newline at end of file
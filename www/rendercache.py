@@ -0,0 +1 @@
+../rendercache.py
\ No newline at end of file
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Resident ParseViz web server: the same page as index.cgi, without starting
+a Python interpreter per request.  parseviz, the render pool, the page cache
+and examples.js are loaded once and stay warm.
+
+At most -renders N requests render at once; up to -queue M more wait for a
+slot, and past that requests get a 503 with Retry-After instead of piling
+up.  Rendered panels and PDFs are served from output/ like the CGI's.
+
+  ./server.py [-port 8000] [-renders 2] [-queue 8] [-j 4] [-maxnodes 250] [-timeout 20]
+      [-maxmem 1024] [-profile LOGFILE]
+
+Trees bigger than -maxnodes nodes are drawn with subtrees summarized, which
+the page can expand one at a time.  A sentence dot can't draw within
+-timeout seconds and -maxmem MB gets a placeholder, and the rest of the
+page still comes out.
+
+-profile appends per-stage and per-sentence timings of every render to
+LOGFILE, one JSON object per line.
+
+(Python 2 has no asyncio; this is a threading HTTP server, one thread per
+connection, with the rendering gated by a semaphore.)
+"""
+from __future__ import with_statement
+import sys,os,cgi,threading,mimetypes,traceback
+import BaseHTTPServer, SocketServer
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import parseviz, rendercache, viewer
+from cgiutil import unicodify
+
+class Busy(Exception): pass
+
+class RenderGate(object):
+  """Lets `slots` renders run at once and up to `queue` more wait."""
+  def __init__(self, slots, queue):
+    self.slots = threading.Semaphore(slots)
+    self.queue = queue
+    self.waiting = 0
+    self.lock = threading.Lock()
+
+  def __enter__(self):
+    with self.lock:
+      if self.waiting >= self.queue:
+        raise Busy()
+      self.waiting += 1
+    self.slots.acquire()
+    with self.lock:
+      self.waiting -= 1
+
+  def __exit__(self, *exc):
+    self.slots.release()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  server_version = "ParseViz"
+
+  def do_GET(self):
+    path, _, query = self.path.partition('?')
+    if path.startswith('/output/'):
+      return self.send_static(path[1:])
+    if path != '/':
+      return self.send_error(404)
+    self.send_page(cgi.parse_qs(query))
+
+  def do_POST(self):
+    n = int(self.headers.getheader('content-length') or 0)
+    self.send_page(cgi.parse_qs(self.rfile.read(n)))
+
+  def send_page(self, vars):
+    parsedata = unicodify(vars.get('parsedata', [''])[0])
+    cache = self.server.cache
+    try:
+      if vars.get('panels'):
+        start = int(vars.get('start', [0])[0])
+        count = int(vars.get('count', [viewer.PANELS_PER_PAGE])[0])
+        panels, more = self.panels(parsedata, start, count)
+        return self.send_body(viewer.panels_json(panels, more, cache), 'application/json')
+      h = viewer.page_head(self.server.examples_js) + viewer.page_form(parsedata)
+      if parsedata and vars.get('pdf'):
+        h += viewer.page_result(self.document(parsedata), cache)
+      elif parsedata:
+        panels, more = self.panels(parsedata)
+        h += viewer.page_panels(panels, more, cache)
+    except Busy:
+      self.send_response(503)
+      self.send_header('Retry-After', '5')
+      self.send_header('Content-Type', 'text/html')
+      self.end_headers()
+      self.wfile.write("Too many renders in progress, try again in a few seconds.\n")
+      return
+    except (parseviz.BadSexpr, ValueError), e:
+      # input that doesn't parse, or a start/count that isn't a number
+      return self.send_failure(400, "Can't read the input: %s" % parseviz.error_text(e))
+    except Exception, e:
+      traceback.print_exc()
+      return self.send_failure(500, "Rendering failed: %s" % parseviz.error_text(e))
+    self.send_body(h, 'text/html; charset=utf-8')
+
+  def document(self, parsedata):
+    cache = self.server.cache
+    if cache.has(viewer.document_key(cache, parsedata)):
+      return viewer.render_document(cache, parsedata, self.server.profile_log)
+    with self.server.gate:
+      return viewer.render_document(cache, parsedata, self.server.profile_log)
+
+  def panels(self, parsedata, start=0, count=viewer.PANELS_PER_PAGE):
+    # only renders of sentences that changed wait for a slot
+    panels, missing, more = viewer.panel_jobs(self.server.cache, parsedata, start, count)
+    if missing:
+      with self.server.gate:
+        failed = viewer.render_panel_jobs(self.server.cache, missing, self.server.profile_log)
+      panels = viewer.with_placeholders(panels, failed)
+    return panels, more
+
+  def send_body(self, h, content_type):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(h)))
+    self.end_headers()
+    self.wfile.write(h)
+
+  def send_failure(self, code, message):
+    self.send_response(code)
+    self.send_header('Content-Type', 'text/plain; charset=utf-8')
+    self.send_header('Content-Length', str(len(message)+1))
+    self.end_headers()
+    self.wfile.write(message + "\n")
+
+  def send_static(self, path):
+    name = os.path.basename(path)
+    full = os.path.join(self.server.cache.directory, name)
+    if name.startswith('.') or not os.path.isfile(full):
+      return self.send_error(404)
+    with open(full, 'rb') as f:
+      data = f.read()
+    self.send_response(200)
+    self.send_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def arg(name, default):
+  return int(sys.argv[sys.argv.index(name)+1]) if name in sys.argv else default
+
+if __name__=='__main__':
+  parseviz.QUIET = True
+  parseviz.WORKERS = arg('-j', parseviz.WORKERS)
+  parseviz.MAX_NODES = arg('-maxnodes', 250)
+  parseviz.RENDER_TIMEOUT = arg('-timeout', 20)
+  parseviz.RENDER_MEMORY_MB = arg('-maxmem', 1024)
+  server = Server(('', arg('-port', 8000)), Handler)
+  server.cache = rendercache.RenderCache("output", max_bytes=500*1024*1024)
+  parseviz.CACHE = server.cache
+  server.gate = RenderGate(arg('-renders', 2), arg('-queue', 8))
+  server.profile_log = sys.argv[sys.argv.index('-profile')+1] if '-profile' in sys.argv else None
+  server.examples_js = open("examples.js").read() if os.path.exists("examples.js") else ""
+  print "ParseViz on port %d" % server.server_address[1]
+  server.serve_forever()
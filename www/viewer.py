@@ -0,0 +1,326 @@
+"""
+The ParseViz web page, shared by index.cgi and server.py.
+Each function returns a piece of the page as a string; the caller prints or
+sends them in order.
+"""
+from __future__ import with_statement
+import cgi,json,time,threading,itertools
+from cStringIO import StringIO
+
+import parseviz
+
+def safehtml(x):
+  return cgi.escape(unicode(x),quote=True).encode('utf8')
+
+def page_head(examples_js):
+  h = """ <!-- tag soup 4ever -->
+<title>ParseViz</title>
+<style>
+body{font-family:"Helvetica Neue",arial, sans-serif; font-size:10pt; }
+td  {font-family:"helvetica neue",arial, sans-serif; font-size:10pt; }
+form {padding-top:0;padding-bottom:0; margin-top:0;margin-bottom:0;}
+.panel {border-top:1px solid #ddd; padding:4px 0;}
+.panel img {max-width:100%;}
+.subtree {margin-left:2em;}
+</style>
+"""
+  h += """<script src=http://ajax.googleapis.com/ajax/libs/jquery/1.4.1/jquery.min.js></script>\n"""
+  #h += """<script src=autoHeight.js></script>\n"""
+  h += """<script>
+examples = {}
+
+function do_example(name) {
+  $('textarea').val(examples[name])
+  $('form#parseform').submit()
+}
+
+function resize_viewer() {
+  if ($('object').length > 0) {
+    var newheight = $(window).height() - $('#topstuff').height() - $('#topstuff').offset().top - 5;
+    $('object').attr('height', newheight);
+  }
+}
+
+$(document).ready(function(){
+
+  $(window).resize(resize_viewer);
+  resize_viewer();
+  //setInterval(resize_viewer, 200);
+
+  if ($('[name=parsedata]').text().length == 0) {
+    $('input[name=s]').focus();
+  }
+
+  // with panels on the page, resubmitting only fetches the list of panel
+  // images and swaps the ones that changed
+  submitted = $('textarea[name=parsedata]').val();
+  var want_pdf = false;
+  $('input[name=pdf]').click(function() { want_pdf = true; });
+  $('form#parseform').submit(function() {
+    if (want_pdf || $('#panels').length == 0) return true;
+    submitted = $('textarea[name=parsedata]').val();
+    var count = Math.max($('#panels > .panel').length, panels_per_page);
+    $.post('.', {parsedata: submitted, panels: 1, start: 0, count: count}, update_panels, 'json');
+    return false;
+  });
+
+  // later panels are fetched a page at a time as they scroll into view
+  $(window).scroll(more_panels);
+  more_panels();
+
+  // a summarized subtree is rendered on its own under the link, once
+  $('a.expand').live('click', function() {
+    var link = $(this);
+    if (link.next('.subtree').length == 0) {
+      $.post('.', {parsedata: link.attr('data-sexpr'), panels: 1, start: 0, count: 1}, function(data) {
+        link.after("<div class=subtree>" + panel_html(data.panels[0], data.expand[0]) + "</div>");
+      }, 'json');
+    } else {
+      link.next('.subtree').toggle();
+    }
+    return false;
+  });
+})
+
+var panels_per_page = %d;
+var submitted = null;   // the parsedata the panels on the page are for
+var loading = false;
+
+function escape_html(s) {
+  return s.replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
+}
+
+// same as viewer.panel_html
+function panel_html(src, expand) {
+  var h = "<div class=panel><img src='" + src + "'>";
+  for (var i = 0; i < expand.length; i++) {
+    h += "<div><a href=# class=expand data-sexpr=\"" + escape_html(expand[i][1]) + "\">[+] " + escape_html(expand[i][0]) + "</a></div>";
+  }
+  return h + "</div>";
+}
+
+function update_panels(data) {
+  var panels = $('#panels > .panel');
+  for (var i = 0; i < data.panels.length; i++) {
+    if (i < panels.length) {
+      if ($(panels[i]).children('img').attr('src') != data.panels[i]) {
+        $(panels[i]).replaceWith(panel_html(data.panels[i], data.expand[i]));
+      }
+    } else {
+      $('#panels').append(panel_html(data.panels[i], data.expand[i]));
+    }
+  }
+  panels.slice(data.panels.length).remove();
+  set_more(data.more);
+}
+
+function more_panels() {
+  if (loading || $('#more').length == 0) return;
+  if ($('#more').offset().top > $(window).scrollTop() + 2*$(window).height()) return;
+  loading = true;
+  var text = submitted;
+  $.post('.', {parsedata: text, panels: 1, start: $('#panels > .panel').length, count: panels_per_page},
+    function(data) {
+      loading = false;
+      if (text != submitted) return;   // resubmitted meanwhile
+      for (var i = 0; i < data.panels.length; i++) {
+        $('#panels').append(panel_html(data.panels[i], data.expand[i]));
+      }
+      set_more(data.more);
+      more_panels();
+    }, 'json');
+}
+
+function set_more(more) {
+  if (more && $('#more').length == 0) $('#panels').after("<div id=more>loading more...</div>");
+  if (!more) $('#more').remove();
+}
+
+%s
+
+</script>
+""" % (PANELS_PER_PAGE, examples_js)
+  h += "<div id=topstuff>\n" ## topstuff
+  h += """<div>
+<span style="font-size:130%; font-weight:bold"><a href=.>ParseViz</a> - parse visualization</span>
+<small>
+&nbsp; <a href=http://github.com/brendano/parseviz>code and documentation on github</a>
+by <a href=http://brenocon.com>brendan</a>
+</small>
+</div>
+
+"""
+  return h
+
+def page_form(parsedata):
+  h = "<form id=parseform action=. method=post>\n"
+  h += """Enter parse(s).
+Examples:
+  <small>
+<a href="javascript:do_example('tree1')">[tree]</a>
+<a href="javascript:do_example('tree_mobydick')">[big tree: melville]</a>
+<a href="javascript:do_example('dep1')">[deps]</a>
+<a href="javascript:do_example('many_trees')">[many trees]</a>
+<a href="javascript:do_example('many_deps')">[many deps]</a>
+<a href="javascript:do_example('malt')">[malt-format deps]</a>
+<a href="javascript:do_example('jsent')">[jsent-format tree/deps]</a>
+</small>
+
+  <br>
+"""
+  h += """
+<textarea name=parsedata rows=6 cols=100 style="font-family: helvetica,arial, sans-serif; font-size:9pt; width:90%%">%s</textarea>
+<br>
+<input type=submit> <input type=submit name=pdf value="as one PDF">
+</form>
+
+""" % safehtml(parsedata)
+  return h
+
+def document_key(cache, parsedata):
+  return cache.key('pdf', parsedata, parseviz.style_key())
+
+_log_lock = threading.Lock()
+
+def render_document(cache, parsedata, profile_log=None):
+  """renders the whole input to one PDF in the cache, returns its path.
+  profile_log: file to append the render's parseviz.Profile to, as a line
+  of JSON"""
+  key = document_key(cache, parsedata)
+  if not cache.has(key):
+    buf = StringIO()
+    profile = parseviz.Profile() if profile_log else None
+    errors = []
+    # sentences dot can't do within parseviz.RENDER_TIMEOUT get a page
+    # saying so.  That document goes in the cache under a key of its own,
+    # so the next request for this input tries them again.
+    parseviz.smart_process(parsedata, 'pdf', out=buf, profile=profile, errors=errors)
+    if errors:
+      key = cache.key('pdf', parsedata, parseviz.style_key(), json.dumps(errors, sort_keys=True))
+    cache.put(key, buf.getvalue())
+    if profile:
+      log_profile(profile_log, profile, key=key, input_bytes=len(parsedata),
+          output_bytes=buf.tell(), errors=errors)
+  return cache.path(key)
+
+def log_profile(profile_log, profile, **info):
+  report = profile.report()
+  report.update(info, time=time.time())
+  with _log_lock:
+    with open(profile_log, 'a') as f:
+      f.write(json.dumps(report, sort_keys=True) + "\n")
+
+# Panels: one image per page, named by the hash of its parse, so a
+# resubmission only renders the sentences that changed and the browser
+# only fetches their images.  They're rendered and sent a page of
+# PANELS_PER_PAGE at a time, the rest when the user scrolls to them, so the
+# first ones show up as fast for a thousand sentences as for ten.
+#
+# Trees past parseviz.MAX_NODES have subtrees drawn as summary nodes; each
+# panel lists those, and clicking one renders that subtree as its own panel.
+
+PANEL_FORMAT = 'png'
+PANELS_PER_PAGE = 20
+
+def sentence_jobs(parsedata, start=0, count=None):
+  """(to_tuples, parse) for pages start..start+count, split the way
+  smart_process splits; the pages after those aren't converted"""
+  input_format, parses = parseviz.detect_type(parsedata.strip())
+  if input_format is None: return []
+  jobs = parseviz.input_jobs(input_format, parses)
+  return list(itertools.islice(jobs, start, None if count is None else start+count))
+
+def expansions(to_tuples, parse):
+  """[summary label, subtree s-expression] for each collapsed subtree of a page"""
+  try:
+    if to_tuples is parseviz.sexpr_to_tuples:
+      sexpr = parse
+    elif to_tuples is parseviz.jsent_to_tree_tuples:
+      sexpr = parseviz.jsent_record(parse)['parse']
+    else:
+      return []
+    tree = parseviz.parse_sexpr(sexpr)
+  except (parseviz.BadSexpr, ValueError):
+    # a parse that doesn't read; its panel is a placeholder saying why
+    return []
+  return [[parseviz.summary_label(tree, i), parseviz.subtree_sexpr(tree, i)]
+      for i in parseviz.collapsed_nodes(tree, parseviz.MAX_NODES, parseviz.MAX_DEPTH)]
+
+def panel_jobs(cache, parsedata, start=0, count=PANELS_PER_PAGE):
+  """returns ((cache key, expansions) of panels start..start+count, jobs for
+  the ones that aren't rendered yet, whether there are panels after these)"""
+  jobs = sentence_jobs(parsedata, start, count+1)
+  more = len(jobs) > count
+  jobs = jobs[:count]
+  style = parseviz.style_key()
+  keys = [parseviz.page_key(cache, PANEL_FORMAT, to_tuples, parse, style) for to_tuples,parse in jobs]
+  missing = [job for job,key in zip(jobs,keys) if not cache.has(key)]
+  panels = [(key, expansions(to_tuples, parse)) for key,(to_tuples,parse) in zip(keys,jobs)]
+  return panels, missing, more
+
+def render_panel_jobs(cache, jobs, profile_log=None):
+  """renders the jobs into the cache.  Returns {key: placeholder key} for
+  the ones dot couldn't render: the placeholder is cached under a key of
+  its own, so those sentences are tried again next time.
+  profile_log: file to append the render's parseviz.Profile to"""
+  style = parseviz.style_key()
+  profile = parseviz.Profile() if profile_log else None
+  errors = []
+  failed = {}
+  # panel_jobs just found these missing; looking again would count every
+  # miss twice
+  pages = parseviz.render_parses(jobs, format=PANEL_FORMAT, cache=cache, profile=profile,
+      errors=errors, lookup=False)
+  for (to_tuples, parse), page in zip(jobs, pages):
+    if isinstance(page, parseviz.Placeholder):
+      key = parseviz.page_key(cache, PANEL_FORMAT, to_tuples, parse, style)
+      failed[key] = cache.key(PANEL_FORMAT, 'placeholder', str(page.error))
+      cache.put(failed[key], page)
+  if profile and jobs:
+    log_profile(profile_log, profile, panels=len(jobs), errors=errors)
+  return failed
+
+def with_placeholders(panels, failed):
+  return [(failed.get(key, key), expand) for key,expand in panels]
+
+def render_panels(cache, parsedata, start=0, count=PANELS_PER_PAGE, profile_log=None):
+  """returns (panels, more) as panel_jobs does, once they're rendered"""
+  panels, missing, more = panel_jobs(cache, parsedata, start, count)
+  failed = render_panel_jobs(cache, missing, profile_log)
+  return with_placeholders(panels, failed), more
+
+def panels_json(panels, more, cache):
+  return json.dumps({'panels': [cache.path(key) for key,expand in panels],
+      'expand': [expand for key,expand in panels], 'more': more})
+
+def panel_html(src, expand):
+  h = "<div class=panel><img src='%s'>" % src
+  for label, sexpr in expand:
+    h += '<div><a href=# class=expand data-sexpr="%s">[+] %s</a></div>' % (safehtml(sexpr), safehtml(label))
+  return h + "</div>\n"
+
+def page_panels(panels, more, cache):
+  h = "<!-- cache: hits=%(hits)s misses=%(misses)s -->\n" % cache.stats()
+  h += "</div>\n" ## topstuff
+  h += "<div id=panels>\n"
+  for key, expand in panels:
+    h += panel_html(cache.path(key), expand)
+  h += "</div>\n"
+  if more:
+    h += "<div id=more>loading more...</div>\n"
+  return h
+
+def page_result(final, cache):
+  h = "<!-- cache: hits=%(hits)s misses=%(misses)s -->\n" % cache.stats()
+  # url = "http://www.ark.cs.cmu.edu/parseviz/%s" % final
+  # http://docs.google.com/viewer has minimal info
+
+  # g_url = "http://docs.google.com/viewer?url=%s" % urllib.quote(url)
+  h += "<a target=_blank href='%s'>[Open in new window]</a>\n" % final
+  h += "</div>\n" ## topstuff
+  h += r"""
+  <object data="{final}" type="application/pdf" width="100%" height=400>
+    <p><a target=_blank href='{final}'>[Open in new window]</a>
+  </object>
+  """.format(final=final)
+  return h